@@ -0,0 +1,37 @@
+'''
+Requests associated to the administration of the api
+'''
+from flask import jsonify, make_response
+from flask.views import MethodView
+
+from app import REQUEST_PROFILER
+from common.status_codes import STATUS_FORBIDDEN, STATUS_NOT_FOUND, STATUS_OK
+
+
+class ProfilesAPI(MethodView):
+    '''
+    Exposes the request profiles recorded by the sampling profiler.
+    The requests must carry the profiling token in the 'X-Profile' header.
+    '''
+
+    def get(self, profile_id=None):
+        '''
+        Get the collapsed stacks (flamegraph input) of the profile with the specified profile_id.
+        Get the summary of all stored profiles.
+        '''
+        if not REQUEST_PROFILER.is_authorised():
+            return make_response(
+                jsonify({'message': 'A valid profiling token is required'}), STATUS_FORBIDDEN
+            )
+        if profile_id is None:
+            return make_response(jsonify(REQUEST_PROFILER.store.list()), STATUS_OK)
+        profile = REQUEST_PROFILER.store.get(profile_id)
+        if profile is None:
+            return make_response(
+                jsonify(
+                    {'message': 'The profile with id {} was not found'.format(profile_id)}),
+                STATUS_NOT_FOUND
+            )
+        response = make_response(profile['collapsed'], STATUS_OK)
+        response.mimetype = 'text/plain'
+        return response
@@ -1,15 +1,29 @@
 '''
 Requests associated to Poles
 '''
-from flask import jsonify, make_response, request
+from flask import Response, current_app, jsonify, make_response, request
 from flask.views import MethodView
 
 from app import DB_SERVICE as DBService
+from app import POLE_NUMBER_INDEX, POLE_TILES, POLES_SNAPSHOT
+from common.bk_tree import distance_from, max_search_distance
 # from common.db_service import DBService
-from common.exceptions import DBError, EntryNotFoundError, InvalidColumnsError
+from common.exceptions import (DBError, EntryNotFoundError, IndexNotReadyError,
+                               InvalidColumnsError, InvalidValuesError,
+                               SnapshotNotReadyError)
 from common.status_codes import (STATUS_CREATED, STATUS_INTERNAL_ERROR,
                                  STATUS_INVALID_INPUT, STATUS_NO_INPUT,
-                                 STATUS_NOT_FOUND, STATUS_OK)
+                                 STATUS_NOT_FOUND, STATUS_NOT_MODIFIED,
+                                 STATUS_OK, STATUS_PARTIAL_CONTENT,
+                                 STATUS_RANGE_NOT_SATISFIABLE,
+                                 STATUS_SERVICE_UNAVAILABLE)
+
+# size of the chunks in which a snapshot is streamed to the client
+SNAPSHOT_CHUNK_SIZE = 64 * 1024
+
+# defaults of the fuzzy pole number search
+FUZZY_DEFAULT_MAX_DISTANCE = 1
+FUZZY_DEFAULT_LIMIT = 20
 
 
 class PolesAPI(MethodView):
@@ -63,6 +77,7 @@ class PolesAPI(MethodView):
             )
         try:
             pole_id = DBService.insert_data(self.db_table, **new_pole_data)
+            POLE_TILES.invalidate_row(new_pole_data)
         except InvalidColumnsError as invalid_columns_error:
             invalid_columns_str = ', '.join(invalid_columns_error.columns)
             message = 'Unexpected data input(s): [' + invalid_columns_str + ']'
@@ -73,6 +88,8 @@ class PolesAPI(MethodView):
             return make_response(
                 jsonify({'message': error.message}), STATUS_INTERNAL_ERROR
             )
+        POLE_NUMBER_INDEX.add(pole_id, pole_number_)
+        POLES_SNAPSHOT.schedule_rebuild()
         return make_response(
             jsonify(
                 {'message': 'The pole has been added successfully', 'id': pole_id}),
@@ -89,8 +106,14 @@ class PolesAPI(MethodView):
                 jsonify({'message': 'No data input provided'}), STATUS_NO_INPUT
             )
         try:
+            old_pole = None
+            if POLE_TILES.shows_columns(data.keys()):
+                # the current data is needed to know which map tiles show the pole
+                old_pole = DBService.select_data(self.db_table, data_id=pole_id)
             DBService.update_data(table=self.db_table,
-                                  data_id=pole_id, new_data=data)
+                                  data_id=pole_id, new_data=data, current_data=old_pole)
+            if old_pole is not None:
+                POLE_TILES.invalidate_update(old_pole, data)
         except EntryNotFoundError:
             return make_response(
                 jsonify(
@@ -103,10 +126,20 @@ class PolesAPI(MethodView):
             return make_response(
                 jsonify({'message': message}), STATUS_INVALID_INPUT
             )
+        except InvalidValuesError as invalid_values_error:
+            invalid_columns_str = ', '.join(invalid_values_error.columns)
+            message = 'Invalid value(s) for: [' + invalid_columns_str + ']'
+            return make_response(
+                jsonify({'message': message}), STATUS_INVALID_INPUT
+            )
         except DBError as error:
             return make_response(
                 jsonify({'message': error.message}), STATUS_INTERNAL_ERROR
             )
+        if 'pole_number' in data:
+            # pole number updates are never queued, so they are written by now
+            POLE_NUMBER_INDEX.update(pole_id, data['pole_number'])
+        POLES_SNAPSHOT.schedule_rebuild()
         return make_response(
             jsonify(
                 {'message': 'The pole with id {} has been updated successfully'.format(
@@ -120,7 +153,8 @@ class PolesAPI(MethodView):
         Delete a Pole
         '''
         try:
-            DBService.delete_data(table=self.db_table, data_id=pole_id)
+            old_pole = DBService.delete_data(table=self.db_table, data_id=pole_id)
+            POLE_TILES.invalidate_row(old_pole)
         except EntryNotFoundError:
             return make_response(
                 jsonify(
@@ -131,6 +165,8 @@ class PolesAPI(MethodView):
             return make_response(
                 jsonify({'message': error.message}), STATUS_INTERNAL_ERROR
             )
+        POLE_NUMBER_INDEX.remove(pole_id)
+        POLES_SNAPSHOT.schedule_rebuild()
         return make_response(
             jsonify(
                 {'message': 'The pole with id {} has been deleted successfully'.format(
@@ -138,3 +174,115 @@ class PolesAPI(MethodView):
             ),
             STATUS_OK
         )
+
+
+class PolesFuzzyAPI(MethodView):
+    '''
+    Exposes the typo-tolerant search of Poles by pole number
+    '''
+    db_table = 'pole'
+
+    def get(self):
+        '''
+        Get the Poles whose pole number is within 'max_distance' edits of 'q',
+        closest first, as {'distance': ..., 'pole': ...}
+        '''
+        query = request.args.get('q', '').strip()
+        if not query:
+            return make_response(
+                jsonify({'message': 'No search query provided'}), STATUS_NO_INPUT
+            )
+        max_distance_limit = max_search_distance(current_app.config['FUZZY_MAX_DISTANCE'])
+        try:
+            max_distance = int(request.args.get('max_distance', FUZZY_DEFAULT_MAX_DISTANCE))
+            limit = int(request.args.get('limit', FUZZY_DEFAULT_LIMIT))
+        except ValueError:
+            return make_response(
+                jsonify({'message': 'max_distance and limit must be integers'}),
+                STATUS_INVALID_INPUT
+            )
+        if not 0 <= max_distance <= max_distance_limit or limit < 1:
+            message = 'max_distance must be between 0 and {} and limit must be positive'.format(
+                max_distance_limit)
+            return make_response(jsonify({'message': message}), STATUS_INVALID_INPUT)
+        try:
+            matches = POLE_NUMBER_INDEX.search(query, max_distance, limit=limit)
+            poles = DBService.select_data_in(
+                self.db_table, pole_id=[pole_id for _, pole_id, _ in matches])
+        except IndexNotReadyError as error:
+            response = make_response(
+                jsonify({'message': error.message}), STATUS_SERVICE_UNAVAILABLE
+            )
+            response.headers['Retry-After'] = '5'
+            return response
+        except DBError as error:
+            return make_response(
+                jsonify({'message': error.message}), STATUS_INTERNAL_ERROR
+            )
+        number_index = DBService.get_valid_columns(self.db_table).index('pole_number')
+        distance_to = distance_from(POLE_NUMBER_INDEX.normalise(query))
+        results = []
+        # the distances are recomputed from the poles as they are now, since the poles
+        # modified or deleted through another worker can be out of date in the index
+        for pole in poles:
+            pole_number = POLE_NUMBER_INDEX.normalise(
+                pole['pole_number'] if isinstance(pole, dict) else pole[number_index])
+            distance = distance_to(pole_number)
+            if distance <= max_distance:
+                results.append((distance, pole_number, pole))
+        results.sort(key=lambda result: result[:2])
+        db_data = [{'distance': distance, 'pole': pole} for distance, _, pole in results]
+        return make_response(jsonify(db_data), STATUS_OK)
+
+
+class PolesSnapshotAPI(MethodView):
+    '''
+    Exposes the prebuilt snapshot of all Poles for bulk downloads.
+    The snapshot is a gzip-compressed JSON file, served from a memory map.
+    Supports conditional (ETag) and single byte-range requests.
+    '''
+
+    def get(self):
+        '''
+        Download the gzip-compressed JSON of all Poles
+        '''
+        try:
+            version, snapshot = POLES_SNAPSHOT.current()
+        except SnapshotNotReadyError as error:
+            response = make_response(
+                jsonify({'message': error.message}), STATUS_SERVICE_UNAVAILABLE
+            )
+            response.headers['Retry-After'] = '5'
+            return response
+        length = len(snapshot)
+        if request.if_none_match.contains(version):
+            response = Response(status=STATUS_NOT_MODIFIED)
+            response.set_etag(version)
+            return response
+        start, stop = 0, length
+        status = STATUS_OK
+        # a range request is only honoured if the client still holds the current version
+        if request.range and request.if_range.etag in (None, version):
+            byte_range = request.range.range_for_length(length)
+            if byte_range is not None:
+                start, stop = byte_range
+                status = STATUS_PARTIAL_CONTENT
+            elif len(request.range.ranges) == 1:
+                response = Response(status=STATUS_RANGE_NOT_SATISFIABLE)
+                response.headers['Content-Range'] = 'bytes */{}'.format(length)
+                return response
+
+        def generate():
+            for offset in range(start, stop, SNAPSHOT_CHUNK_SIZE):
+                yield snapshot[offset:min(offset + SNAPSHOT_CHUNK_SIZE, stop)]
+
+        response = Response(generate(), status=status, mimetype='application/gzip',
+                            direct_passthrough=True)
+        response.content_length = stop - start
+        response.set_etag(version)
+        response.accept_ranges = 'bytes'
+        response.headers['Content-Disposition'] = \
+            'attachment; filename=poles-{}.json.gz'.format(version)
+        if status == STATUS_PARTIAL_CONTENT:
+            response.content_range = request.range.make_content_range(length)
+        return response
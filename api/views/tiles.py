@@ -0,0 +1,36 @@
+'''
+Requests associated to map tiles
+'''
+from flask import jsonify, make_response
+from flask.views import MethodView
+
+from app import DB_SERVICE as DBService
+from app import POLE_TILES
+from common.exceptions import DBError
+from common.status_codes import STATUS_INTERNAL_ERROR, STATUS_NOT_FOUND, STATUS_OK
+from common.vector_tiles import is_valid_tile
+
+
+class PoleTilesAPI(MethodView):
+    '''
+    Exposes the Poles as Mapbox Vector Tiles, in the layer 'poles'
+    '''
+
+    def get(self, z, x, y):
+        '''
+        Get the vector tile (z, x, y) of the Poles
+        '''
+        if not is_valid_tile(z, x, y):
+            return make_response(
+                jsonify({'message': 'The tile {}/{}/{} does not exist'.format(z, x, y)}),
+                STATUS_NOT_FOUND
+            )
+        try:
+            tile = POLE_TILES.get_tile(DBService, z, x, y)
+        except DBError as error:
+            return make_response(
+                jsonify({'message': error.message}), STATUS_INTERNAL_ERROR
+            )
+        response = make_response(tile, STATUS_OK)
+        response.mimetype = 'application/vnd.mapbox-vector-tile'
+        return response
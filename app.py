@@ -1,11 +1,13 @@
 '''
 The main entry point of the entire application
 '''
+from atexit import register as register_exit_handler
 from logging import error as log_error
 # from logging import info as log_info
 from os import environ as env
 from sqlite3 import connect as connect_sqlite
 
+from click import echo
 from flask import Flask, abort, g, redirect
 from psycopg2 import connect as connect_postgresql
 from psycopg2 import OperationalError
@@ -14,13 +16,40 @@ from psycopg2.extras import RealDictCursor
 
 from common import config
 from common.status_codes import STATUS_INTERNAL_ERROR
+from common.bk_tree import FuzzyIndex
 from common.db_service import DBService as _DBService
+from common.profiler import ProfileStore, RequestProfiler
+from common.snapshot import TableSnapshot
+from common.vector_tiles import PointTiles, TileCache, TileStore
+from common.write_buffer import WriteBuffer, to_float
 
 
 app = Flask(__name__)
 app.config.from_object(config)
 
 
+def create_db_connection(any_thread=False):
+    '''
+    Open a new connection to the database for the current environment.
+    With 'any_thread', the connection may be used from other threads than the
+    one that opened it (one at a time).
+    '''
+    if app.config['DEBUG'] is True:
+        # we are in debug mode, so we connect to the sqlite db file
+        _db_connection = connect_sqlite(
+            app.config['SQLITE_DB'], isolation_level=None, check_same_thread=not any_thread)
+        log_error("CONNECTED TO SQLITE DATABASE")
+    else:
+        # we are in production so use the db connection
+        # parameters defined in the DATABASE_URL environmen
+        # variable
+        _db_connection = connect_postgresql(
+            env.get('DATABASE_URL'), cursor_factory=RealDictCursor)
+        log_error(
+            "**********CONNECTED TO HEROKU POSTGRES DATABASE**********")
+    return _db_connection
+
+
 def get_db_connection():
     '''
     Create a new database connection if one doesn't exist already
@@ -30,18 +59,7 @@ def get_db_connection():
         _db_connection = getattr(g, '_db_connection', None)
         if _db_connection is None:
             try:
-                if app.config['DEBUG'] is True:
-                    # we are in debug mode, so we connect to the sqlite db file
-                    _db_connection = connect_sqlite('sqlite.db', isolation_level=None)
-                    log_error("CONNECTED TO SQLITE DATABASE")
-                else:
-                    # we are in production so use the db connection
-                    # parameters defined in the DATABASE_URL environmen
-                    # variable
-                    _db_connection = connect_postgresql(
-                        env.get('DATABASE_URL'), cursor_factory=RealDictCursor)
-                    log_error(
-                        "**********CONNECTED TO HEROKU POSTGRES DATABASE**********")
+                _db_connection = create_db_connection()
             except OperationalError as error:
                 log_error('app.py >> get_db_connection(): ' + error.message)
                 abort(STATUS_INTERNAL_ERROR)
@@ -49,15 +67,86 @@ def get_db_connection():
         return _db_connection
 
 
-DB_SERVICE = _DBService(
-    get_db_connection(), 'SQLITE' if app.config['DEBUG'] else 'POSTGRESQL'
+DB_BACKEND = 'SQLITE' if app.config['DEBUG'] else 'POSTGRESQL'
+
+# snapshot of the whole pole table, served for bulk downloads.
+# it is built with its own db connection since rebuilds run in the background
+POLES_SNAPSHOT = TableSnapshot(
+    'pole',
+    lambda: _DBService(create_db_connection(), DB_BACKEND),
+    app.config['SNAPSHOT_DIR'],
+    rebuild_delay=app.config['SNAPSHOT_REBUILD_DELAY']
+)
+POLES_SNAPSHOT.start()
+
+# optional write-behind mode, coalescing the frequent location nudges of poles.
+# the other columns (e.g. the unique pole_number) are always updated right away.
+# like the snapshot, the flushes use their own db connection
+WRITE_BUFFER = None
+if app.config['WRITE_BEHIND']:
+    WRITE_BUFFER = WriteBuffer(
+        lambda: _DBService(create_db_connection(any_thread=True), DB_BACKEND),
+        {'pole': {'lat': to_float, 'long': to_float}},
+        flush_interval=app.config['WRITE_BEHIND_INTERVAL'],
+        max_pending=app.config['WRITE_BEHIND_MAX_PENDING'],
+        on_flush=lambda table: POLES_SNAPSHOT.schedule_rebuild()
+    )
+    # write the pending updates before the worker exits
+    register_exit_handler(WRITE_BUFFER.close)
+
+DB_SERVICE = _DBService(get_db_connection(), DB_BACKEND, write_buffer=WRITE_BUFFER)
+
+# vector tiles of the poles for the web map.
+# the low zoom tiles, which cover the most poles, are shared by the workers on disk
+# and rebuilt in the background after writes, with their own db connection
+POLE_TILES = PointTiles(
+    'pole',
+    DB_SERVICE.get_valid_columns('pole'),
+    TileCache(app.config['TILE_CACHE_SIZE'], app.config['TILE_CACHE_MAX_AGE']),
+    store=TileStore(app.config['TILE_DIR'], app.config['TILE_STORE_MAX_ZOOM']),
+    db_service_factory=lambda: _DBService(create_db_connection(), DB_BACKEND),
+    refresh_delay=app.config['TILE_REFRESH_DELAY'],
+    id_column='pole_id',
+    property_columns=('pole_id', 'pole_number'),
+    layer_name='poles'
 )
 
+# typo-tolerant index of the pole numbers, loaded in the background when the app
+# starts. it is saved to disk, so the workers started later do not build it again
+POLE_NUMBER_INDEX = FuzzyIndex(
+    'pole',
+    DB_SERVICE.get_valid_columns('pole'),
+    'pole_number',
+    'pole_id',
+    lambda: _DBService(create_db_connection(), DB_BACKEND),
+    max_age=app.config['FUZZY_INDEX_MAX_AGE'],
+    save_path=app.config['FUZZY_INDEX_PATH']
+)
+POLE_NUMBER_INDEX.start()
+
+REQUEST_PROFILER = RequestProfiler(
+    ProfileStore(app.config['PROFILE_DIR'], app.config['PROFILE_MAX_ENTRIES']),
+    token=app.config['PROFILE_TOKEN'],
+    sample_rate=app.config['PROFILE_SAMPLE_RATE'],
+    interval=app.config['PROFILE_INTERVAL'],
+    ignored_paths=('/admin/profiles',)
+)
+app.wsgi_app = REQUEST_PROFILER.profile_app(app)
+
 
 def index():
     return redirect(app.config['INDEX'])
 
 
+@app.cli.command('precompute-tiles')
+def precompute_tiles():
+    '''
+    Build the vector tiles of the poles up to TILE_STORE_MAX_ZOOM into TILE_DIR
+    '''
+    tile_count = POLE_TILES.precompute(DB_SERVICE)
+    echo('{} tiles written to {}'.format(tile_count, app.config['TILE_DIR']))
+
+
 def register_api(view, endpoint, url, key='id', key_type='int'):
     '''
     Register the url(s) for an typical api endpoint.
@@ -75,10 +164,26 @@ def register_api(view, endpoint, url, key='id', key_type='int'):
 
 
 # # we register the urls for the flask app
-from api.views.poles import PolesAPI
+from api.views.admin import ProfilesAPI
+from api.views.poles import PolesAPI, PolesFuzzyAPI, PolesSnapshotAPI
+from api.views.tiles import PoleTilesAPI
 from api.views.users import UsersAPI
 register_api(UsersAPI, 'users_api', '/users', key='user_id')
 register_api(PolesAPI, 'poles_api', '/poles', key='pole_id')
+app.add_url_rule('/poles/snapshot',
+                 view_func=PolesSnapshotAPI.as_view('poles_snapshot_api'),
+                 methods=['GET', ])
+app.add_url_rule('/poles/fuzzy',
+                 view_func=PolesFuzzyAPI.as_view('poles_fuzzy_api'),
+                 methods=['GET', ])
+app.add_url_rule('/tiles/poles/<int:z>/<int:x>/<int:y>.pbf',
+                 view_func=PoleTilesAPI.as_view('pole_tiles_api'),
+                 methods=['GET', ])
+profiles_view = ProfilesAPI.as_view('profiles_api')
+app.add_url_rule('/admin/profiles', defaults={'profile_id': None},
+                 view_func=profiles_view, methods=['GET', ])
+app.add_url_rule('/admin/profiles/<string:profile_id>',
+                 view_func=profiles_view, methods=['GET', ])
 app.add_url_rule('/', 'index', index)
 
 
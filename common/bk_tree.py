@@ -0,0 +1,406 @@
+'''
+In-memory index for typo-tolerant lookups of short strings (e.g. pole numbers),
+based on a BK-tree (https://en.wikipedia.org/wiki/BK-tree) over the
+Levenshtein edit distance.
+'''
+from logging import error as log_error
+from os import getpid, makedirs, rename, utime
+from os import path as os_path
+from time import time
+
+from common.exceptions import IndexNotReadyError
+from common.os_threads import allocate_lock, start_new_thread
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+try:
+    # C implementation from python-Levenshtein, used when it is installed
+    from Levenshtein import distance as _c_edit_distance
+except ImportError:
+    _c_edit_distance = None
+
+# largest distance searched for without python-Levenshtein: at 2 edits, the pure
+# Python distance makes a search over hundreds of thousands of keys take about half a second
+PURE_PYTHON_MAX_DISTANCE = 1
+
+
+def max_search_distance(max_distance):
+    '''
+    Return the largest distance that can be searched for, up to 'max_distance'
+    '''
+    if _c_edit_distance is None:
+        return min(max_distance, PURE_PYTHON_MAX_DISTANCE)
+    return max_distance
+
+
+def compile_pattern(pattern):
+    '''
+    Precompute 'pattern' for edit_distance(), which is much faster when
+    the same pattern is compared to many strings
+    '''
+    char_masks = {}
+    for i, char in enumerate(pattern):
+        char_masks[char] = char_masks.get(char, 0) | (1 << i)
+    return char_masks, len(pattern)
+
+
+def edit_distance(compiled_pattern, text):
+    '''
+    Return the Levenshtein distance between a pattern compiled with
+    compile_pattern() and 'text'.
+    Uses the bit-parallel algorithm of Myers (1999), as formulated by Hyyro (2001),
+    which processes one character of 'text' per step instead of one DP cell.
+    '''
+    char_masks, length = compiled_pattern
+    if length == 0:
+        return len(text)
+    full = (1 << length) - 1
+    last = 1 << (length - 1)
+    vertical_plus, vertical_minus, score = full, 0, length
+    for char in text:
+        eq = char_masks.get(char, 0)
+        xv = eq | vertical_minus
+        xh = (((eq & vertical_plus) + vertical_plus) ^ vertical_plus) | eq
+        horizontal_plus = vertical_minus | (~(xh | vertical_plus) & full)
+        horizontal_minus = vertical_plus & xh
+        if horizontal_plus & last:
+            score += 1
+        elif horizontal_minus & last:
+            score -= 1
+        horizontal_plus = ((horizontal_plus << 1) | 1) & full
+        horizontal_minus = (horizontal_minus << 1) & full
+        vertical_plus = horizontal_minus | (~(xv | horizontal_plus) & full)
+        vertical_minus = horizontal_plus & xv
+    return score
+
+
+def distance_from(key):
+    '''
+    Return a function computing the edit distance from 'key' to its argument
+    '''
+    if _c_edit_distance is not None:
+        return lambda text: _c_edit_distance(key, text)
+    pattern = compile_pattern(key)
+    return lambda text: edit_distance(pattern, text)
+
+
+class BKTree(object):
+    '''
+    BK-tree of string keys, each key holding the set of ids of the items with that key.
+    A node is a list [key, ids, children], children mapping the distance
+    between the node and the child to the child.
+    Keys are never removed from the tree: removing the last id of a key
+    leaves an empty node that is skipped in the results.
+    '''
+
+    def __init__(self):
+        self.root = None
+        self.size = 0  # number of nodes, including the empty ones
+
+    def add(self, key, item_id):
+        if self.root is None:
+            self.root = [key, set([item_id]), {}]
+            self.size += 1
+            return
+        distance_to = distance_from(key)
+        node = self.root
+        while True:
+            distance = distance_to(node[0])
+            if distance == 0:
+                node[1].add(item_id)
+                return
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [key, set([item_id]), {}]
+                self.size += 1
+                return
+            node = child
+
+    def remove(self, key, item_id):
+        distance_to = distance_from(key)
+        node = self.root
+        while node is not None:
+            distance = distance_to(node[0])
+            if distance == 0:
+                node[1].discard(item_id)
+                return
+            node = node[2].get(distance)
+
+    def search(self, key, max_distance):
+        '''
+        Return (distance, key, ids) of all the keys within 'max_distance' of 'key'
+        '''
+        matches = []
+        if self.root is None:
+            return matches
+        distance_to = distance_from(key)
+        nodes = [self.root]
+        while nodes:
+            node_key, ids, children = nodes.pop()
+            distance = distance_to(node_key)
+            if distance <= max_distance and ids:
+                matches.append((distance, node_key, ids))
+            # by the triangle inequality, matches can only be in the children whose
+            # distance to this node is within max_distance of 'distance'
+            for child_distance in range(max(1, distance - max_distance),
+                                        distance + max_distance + 1):
+                child = children.get(child_distance)
+                if child is not None:
+                    nodes.append(child)
+        return matches
+
+
+class FuzzyIndex(object):
+    '''
+    Typo-tolerant index of 'key_column' of 'table', for looking up the ids
+    ('id_column') of the rows by approximate value.
+    'columns' are the columns of 'table', in the order they are selected in.
+    The index must be kept up to date with add(), update() and remove() once the
+    changes are written to the table. It is also rebuilt when it is older than
+    'max_age' seconds, to pick up the changes made through other workers.
+    The index is built in an OS thread, one build at a time, and saved to
+    'save_path' (if given) so that the other workers can load it instead of
+    building it again. Every change marks the saved index as stale, so that
+    it is never loaded without the changes made since it was built.
+    'db_service_factory' must return a new DBService each time it is called,
+    since the index is built outside of the request thread.
+    '''
+
+    def __init__(self, table, columns, key_column, id_column, db_service_factory,
+                 max_age=300, save_path=None):
+        self.table = table
+        self.columns = columns
+        self.key_column = key_column
+        self.id_column = id_column
+        self.db_service_factory = db_service_factory
+        self.max_age = max_age
+        self.save_path = save_path
+        # touched on every change, to mark the saved index as stale
+        self.changed_path = save_path + '.changed' if save_path else None
+        self._tree = None
+        self._keys = {}  # id -> key
+        self._built_at = None
+        # OS locks, since the index is built in an OS thread
+        self._lock = allocate_lock()
+        self._build_lock = allocate_lock()
+        self._rebuilding = False
+        # changes made while a rebuild is running, replayed on the new tree
+        self._journal = []
+
+    @staticmethod
+    def normalise(value):
+        return u'{}'.format(value).strip().upper()
+
+    def _value(self, row, column):
+        if isinstance(row, dict):
+            return row[column]
+        return row[self.columns.index(column)]
+
+    def _load(self):
+        db_service = self.db_service_factory()
+        try:
+            db_data = db_service.select_data(self.table)
+        finally:
+            db_service.db_connection.close()
+        keys = {}
+        for row in db_data:
+            keys[self._value(row, self.id_column)] = self.normalise(
+                self._value(row, self.key_column))
+        return keys
+
+    @staticmethod
+    def _build_tree(keys):
+        tree = BKTree()
+        for item_id, key in keys.items():
+            tree.add(key, item_id)
+        return tree
+
+    def _build_from_database(self):
+        built_at = time()
+        keys = self._load()
+        tree = self._build_tree(keys)
+        if self.save_path:
+            self._save(built_at, keys, tree)
+        return built_at, keys, tree
+
+    def _build_from_saved(self):
+        '''
+        Load the index saved by any worker if it is recent enough, else build it
+        '''
+        if self.save_path:
+            try:
+                with open(self.save_path, 'rb') as saved_file:
+                    built_at, keys, tree = pickle.load(saved_file)
+                if time() - built_at <= self.max_age and built_at >= self._changed_at():
+                    return built_at, keys, tree
+            except IOError:
+                pass  # not saved yet
+            except Exception as error:
+                log_error('bk_tree.py >> _build_from_saved(): ' + str(error))
+        return self._build_from_database()
+
+    def _changed_at(self):
+        '''
+        Return when the table was last changed through any worker (0 if unknown)
+        '''
+        try:
+            return os_path.getmtime(self.changed_path)
+        except OSError:
+            return 0
+
+    def _mark_changed(self):
+        if not self.changed_path:
+            return
+        try:
+            with open(self.changed_path, 'a'):
+                utime(self.changed_path, None)
+        except (IOError, OSError) as error:
+            log_error('bk_tree.py >> _mark_changed(): ' + str(error))
+
+    def _compacted(self):
+        with self._lock:
+            keys = dict(self._keys)
+            built_at = self._built_at
+        return built_at, keys, self._build_tree(keys)
+
+    def _save(self, built_at, keys, tree):
+        tmp_path = '{}.{}.tmp'.format(self.save_path, getpid())
+        try:
+            save_dir = os_path.dirname(self.save_path)
+            if save_dir and not os_path.isdir(save_dir):
+                makedirs(save_dir)
+            with open(tmp_path, 'wb') as tmp_file:
+                pickle.dump((built_at, keys, tree), tmp_file, pickle.HIGHEST_PROTOCOL)
+            rename(tmp_path, self.save_path)
+        except (IOError, OSError) as error:
+            log_error('bk_tree.py >> _save(): ' + str(error))
+
+    def _rebuild(self, build, wait=False):
+        '''
+        Replace the tree with the (built_at, keys, tree) returned by build(),
+        unless another rebuild is already running ('wait' to run after it instead).
+        Returns False if another rebuild was running.
+        '''
+        if not self._build_lock.acquire(wait):
+            return False
+        try:
+            with self._lock:
+                self._journal = []
+                self._rebuilding = True
+            try:
+                built_at, keys, tree = build()
+            except Exception:
+                with self._lock:
+                    self._journal = []
+                    self._rebuilding = False
+                raise
+            with self._lock:
+                for item_id, key in self._journal:
+                    old_key = keys.pop(item_id, None)
+                    if old_key is not None:
+                        tree.remove(old_key, item_id)
+                    if key is not None:
+                        keys[item_id] = key
+                        tree.add(key, item_id)
+                self._journal = []
+                self._rebuilding = False
+                self._tree, self._keys, self._built_at = tree, keys, built_at
+            return True
+        finally:
+            self._build_lock.release()
+
+    def build(self, wait=False):
+        '''
+        (Re)build the index from all the rows of 'table', unless a build is
+        already running ('wait' to build after it instead)
+        '''
+        return self._rebuild(self._build_from_database, wait)
+
+    def load(self, wait=False):
+        '''
+        Load the saved index if it is recent and up to date, else (re)build it,
+        unless a build is already running ('wait' to load after it instead)
+        '''
+        return self._rebuild(self._build_from_saved, wait)
+
+    def build_in_background(self, build=None):
+        '''
+        Rebuild the index with build() (a (re)build from the database by default)
+        in an OS thread, unless a build is already running
+        '''
+        if self._build_lock.locked():
+            return
+
+        def _build():
+            try:
+                self._rebuild(build or self._build_from_database)
+            except Exception as error:
+                log_error('bk_tree.py >> build_in_background(): ' + str(error))
+        start_new_thread(_build, ())
+
+    def start(self):
+        '''
+        Start loading (or building) the index in the background
+        '''
+        self.build_in_background(self._build_from_saved)
+
+    def _set_key(self, item_id, key):
+        '''
+        Point 'item_id' to 'key' (None to remove it). Must be called with '_lock' held.
+        '''
+        if self._rebuilding:
+            self._journal.append((item_id, key))
+        if self._tree is None:
+            return
+        old_key = self._keys.pop(item_id, None)
+        if old_key is not None:
+            self._tree.remove(old_key, item_id)
+        if key is not None:
+            self._keys[item_id] = key
+            self._tree.add(key, item_id)
+
+    def _compact_if_needed(self):
+        # the removed keys stay in the tree as empty nodes, so the tree
+        # is compacted in the background once they outnumber the live keys
+        tree = self._tree
+        if tree is not None and tree.size > 2 * len(self._keys) + 64:
+            self.build_in_background(self._compacted)
+
+    def add(self, item_id, value):
+        self._mark_changed()
+        with self._lock:
+            self._set_key(item_id, self.normalise(value))
+        self._compact_if_needed()
+
+    def update(self, item_id, value):
+        self.add(item_id, value)
+
+    def remove(self, item_id):
+        self._mark_changed()
+        with self._lock:
+            self._set_key(item_id, None)
+        self._compact_if_needed()
+
+    def search(self, value, max_distance, limit=None):
+        '''
+        Return the rows within 'max_distance' edits of 'value', as
+        (distance, id, key) sorted by distance, then key.
+        Raises IndexNotReadyError if the index is not built yet, instead of
+        waiting for it to be built.
+        '''
+        if self._tree is None:
+            self.start()
+            raise IndexNotReadyError(self.table)
+        if time() - self._built_at > self.max_age:
+            # loads the index rebuilt by another worker, if there is a recent one
+            self.build_in_background(self._build_from_saved)
+        key = self.normalise(value)
+        with self._lock:
+            matches = self._tree.search(key, max_distance)
+            results = [(distance, item_id, match_key)
+                       for distance, match_key, ids in matches for item_id in ids]
+        results.sort(key=lambda result: (result[0], result[2], result[1]))
+        return results[:limit] if limit else results
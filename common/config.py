@@ -6,3 +6,55 @@ from os import environ as env
 DEBUG = True if str(env.get('FLASK_DEBUG', '0')) == '1' else False
 
 INDEX = 'https://odame.github.io/ecg-fault-location-backend/'
+
+# the sqlite database file used in debug mode
+SQLITE_DB = env.get('SQLITE_DB', 'sqlite.db')
+
+# directory where the prebuilt table snapshots (bulk downloads) are written
+SNAPSHOT_DIR = env.get('SNAPSHOT_DIR', 'snapshots')
+
+# seconds to wait after the last write before rebuilding a snapshot
+SNAPSHOT_REBUILD_DELAY = float(env.get('SNAPSHOT_REBUILD_DELAY', '2'))
+
+# token that enables profiling a request on demand (sent in the 'X-Profile' header)
+# and access to the stored profiles. profiling on demand is disabled if unset
+PROFILE_TOKEN = env.get('PROFILE_TOKEN')
+
+# fraction of all requests (0 to 1) that are profiled
+PROFILE_SAMPLE_RATE = float(env.get('PROFILE_SAMPLE_RATE', '0'))
+
+# seconds between two stack samples of a profiled request
+PROFILE_INTERVAL = float(env.get('PROFILE_INTERVAL', '0.005'))
+
+# directory where the request profiles are written, and how many are kept
+PROFILE_DIR = env.get('PROFILE_DIR', 'profiles')
+PROFILE_MAX_ENTRIES = int(env.get('PROFILE_MAX_ENTRIES', '50'))
+
+# write-behind mode: coalesce the updates of the location of poles and write them in batches.
+# the updates are written after WRITE_BEHIND_INTERVAL seconds, or as soon as
+# WRITE_BEHIND_MAX_PENDING poles have pending updates. the queued updates are kept
+# per worker, so reads served by another worker can miss them until they are written
+WRITE_BEHIND = True if str(env.get('WRITE_BEHIND', '0')) == '1' else False
+WRITE_BEHIND_INTERVAL = float(env.get('WRITE_BEHIND_INTERVAL', '0.5'))
+WRITE_BEHIND_MAX_PENDING = int(env.get('WRITE_BEHIND_MAX_PENDING', '100'))
+
+# maximum number of vector tiles cached (per worker), and the seconds after which
+# a cached tile is rebuilt to pick up changes made through other workers
+TILE_CACHE_SIZE = int(env.get('TILE_CACHE_SIZE', '4096'))
+TILE_CACHE_MAX_AGE = float(env.get('TILE_CACHE_MAX_AGE', '60'))
+
+# the vector tiles up to this zoom level are stored in TILE_DIR and shared by
+# the workers (-1 to disable). run `flask precompute-tiles` to build them ahead of time
+TILE_DIR = env.get('TILE_DIR', 'tiles')
+TILE_STORE_MAX_ZOOM = int(env.get('TILE_STORE_MAX_ZOOM', '6'))
+# seconds to wait after the last write before rebuilding the stored tiles that show it.
+# the previous tiles are served until then
+TILE_REFRESH_DELAY = float(env.get('TILE_REFRESH_DELAY', '2'))
+
+# largest max_distance accepted by the fuzzy pole number search (at most 1 without
+# python-Levenshtein), and the seconds
+# after which its index is rebuilt to pick up changes made through other workers
+FUZZY_MAX_DISTANCE = int(env.get('FUZZY_MAX_DISTANCE', '2'))
+FUZZY_INDEX_MAX_AGE = float(env.get('FUZZY_INDEX_MAX_AGE', '60'))
+# file the fuzzy pole number index is saved to, to be shared by the workers
+FUZZY_INDEX_PATH = env.get('FUZZY_INDEX_PATH', 'indexes/pole_number.pickle')
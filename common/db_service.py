@@ -5,7 +5,7 @@ from logging import error as log_error
 from logging import info as log_info
 
 from common.exceptions import (
-    DBError, EntryNotFoundError, InvalidColumnsError, InvalidTableError)
+    DBError, EntryNotFoundError, InvalidColumnsError, InvalidTableError, InvalidValuesError)
 
 DB_ENGINE_SQLITE = 'SQLITE'
 DB_ENGINE_POSTGRESQL = 'POSTGRESQL'
@@ -16,8 +16,10 @@ class DBService(object):
     Contains functions for performing varios CRUD operations on the underlying database
     '''
 
-    def __init__(self, db_connection, backend):
+    def __init__(self, db_connection, backend, write_buffer=None):
         self.backend = backend
+        # optional common.write_buffer.WriteBuffer that coalesces UPDATEs
+        self.write_buffer = write_buffer
         self.placeholder = None
         if self.backend == DB_ENGINE_POSTGRESQL:
             self.placeholder = '%s'
@@ -100,18 +102,36 @@ class DBService(object):
             raise DBError(table, error)
         return insert_id
 
-    def update_data(self, table, data_id, new_data, exclude=None):
+    def get_update_query(self, table, columns):
         '''
-        UPDATE the data in 'table' with the specified 'data_id' the database.
-        List of columns that should be exempted from the update are specified in 'exclude'.
-        'new_data' represent the column:new_value pairs that must be updated.
-        NB: This function is meant to update only a single row in the database
+        Return the query that UPDATEs 'columns' of a single row of 'table'.
+        The query parameters are the new values of 'columns', followed by the id of the row
         '''
         update_query = '''
             UPDATE {table} 
             SET {columns_placeholders}
             WHERE {table}_id={id_placeholder}
         '''
+        # construct the column-value pairs
+        # column_value_pairs_placeholders: 'column_1=%s, column_2=%s, ...'
+        column_value_pairs_placeholders = ', '.join(
+            ['{c}={p}'.format(c=c, p=self.placeholder) for c in columns])
+        return update_query.format(
+            table=table,
+            columns_placeholders=column_value_pairs_placeholders,
+            id_placeholder=self.placeholder
+        )
+
+    def update_data(self, table, data_id, new_data, exclude=None, current_data=None):
+        '''
+        UPDATE the data in 'table' with the specified 'data_id' the database.
+        List of columns that should be exempted from the update are specified in 'exclude'.
+        'new_data' represent the column:new_value pairs that must be updated.
+        If a write buffer handles all the updated columns, the update is queued in it
+        instead of being executed right away. 'current_data' is the row as the caller has
+        just selected it, if it did, which saves checking that the row exists.
+        NB: This function is meant to update only a single row in the database
+        '''
         if not self.is_valid_table(table):
             raise InvalidTableError(table)
         invalid_columns = self.get_invalid_columns(table, new_data.keys())
@@ -123,16 +143,27 @@ class DBService(object):
                 set(exclude).intersection(set(new_data.keys())))
         if illegal_columns:  # if illegal_columns is not null
             raise InvalidColumnsError(table, illegal_columns)
+        if self.write_buffer is not None and self.write_buffer.can_queue(table, new_data):
+            # bad values are rejected now, since the update will only run later on
+            queued_data = {}
+            invalid_columns = []
+            for column, value in new_data.items():
+                try:
+                    queued_data.update(self.write_buffer.convert(table, {column: value}))
+                except (TypeError, ValueError):
+                    invalid_columns.append(column)
+            if invalid_columns:
+                raise InvalidValuesError(table, invalid_columns)
+            # make sure the entry exists, for the same reason
+            if current_data is None and not self.write_buffer.is_pending(table, data_id):
+                self.select_data(table, data_id=data_id)
+            self.write_buffer.queue_update(table, data_id, queued_data)
+            return
+        if self.write_buffer is not None and self.write_buffer.is_pending(table, data_id):
+            # the queued updates of the row are older, so they must not be written after this one
+            self.write_buffer.flush()
         # we generate the query that will be run against the database.
-        # construct the column-value pairs
-        # column_value_pairs_placeholders: 'column_1=%s, column_2=%s, ...'
-        column_value_pairs_placeholders = ', '.join(
-            ['{c}={p}'.format(c=c, p=self.placeholder) for c in new_data.keys()])
-        update_query = update_query.format(
-            table=table,
-            columns_placeholders=column_value_pairs_placeholders,
-            id_placeholder=self.placeholder
-        )
+        update_query = self.get_update_query(table, new_data.keys())
         # query_params: contains all the parameters that will be passed to the query during
         # execution
         query_params = new_data.values() + [data_id]
@@ -150,10 +181,47 @@ class DBService(object):
                 'db_service.py >> update_data() >> update_query execution: ' + error.message)
             raise DBError(table, error)
 
+    def update_data_batch(self, table, updates):
+        '''
+        UPDATE several rows of 'table' in a single transaction.
+        'updates' maps the id of each row to its column:new_value pairs.
+        The columns are expected to have been validated already.
+        Returns the ids of the rows that were not found in the database
+        '''
+        if not self.is_valid_table(table):
+            raise InvalidTableError(table)
+        missing_ids = []
+        try:
+            with self.db_connection:  # required for auto commit/rollback
+                # the sqlite connection is in autocommit mode, so the
+                # transaction has to be opened and closed explicitly
+                if self.backend == DB_ENGINE_SQLITE:
+                    self.cursor.execute('BEGIN')
+                try:
+                    for data_id, new_data in updates.items():
+                        columns = list(new_data.keys())
+                        self.cursor.execute(
+                            self.get_update_query(table, columns),
+                            [new_data[c] for c in columns] + [data_id])
+                        if self.cursor.rowcount != 1:
+                            missing_ids.append(data_id)
+                except Exception:
+                    if self.backend == DB_ENGINE_SQLITE:
+                        self.cursor.execute('ROLLBACK')
+                    raise
+                if self.backend == DB_ENGINE_SQLITE:
+                    self.cursor.execute('COMMIT')
+        except Exception as error:
+            log_error(
+                'db_service.py >> update_data_batch() >> update_query execution: ' + error.message)
+            raise DBError(table, error)
+        return missing_ids
+
     # @staticmethod
     def delete_data(self, table, data_id):
         '''
         DELETE the data in 'table' with the specified 'data_id' from the database.
+        Returns the deleted row, as select_data() would have returned it.
         '''
         if not self.is_valid_table(table):
             raise InvalidTableError(table)
@@ -171,16 +239,27 @@ class DBService(object):
             SET is_active=FALSE 
             WHERE {table}_id={id_placeholder} AND is_active=TRUE
         '''
-        can_deactivate = 'is_active' in self.get_valid_columns(table)
+        valid_columns = self.get_valid_columns(table)
+        can_deactivate = 'is_active' in valid_columns
         query_to_execute = deactivate_query if can_deactivate else delete_query
+        if self.backend == DB_ENGINE_POSTGRESQL:
+            query_to_execute += ' RETURNING {columns} '
         query_to_execute = query_to_execute.format(
-            table=table, id_placeholder=self.placeholder)
+            table=table, id_placeholder=self.placeholder, columns=', '.join(valid_columns))
         query_to_execute = query_to_execute.replace('\n', '')
         try:
             with self.db_connection:  # required for auto commit/rollback
+                if self.backend == DB_ENGINE_SQLITE:
+                    # sqlite cannot return the deleted row, so it is read first
+                    self.cursor.execute(
+                        'SELECT {columns} FROM {table} WHERE {table}_id=?'.format(
+                            columns=', '.join(valid_columns), table=table), [data_id])
+                    deleted_rows = self.cursor.fetchall()
                 self.cursor.execute(
                     query_to_execute, [data_id])
                 affected_rows = self.cursor.rowcount
+                if self.backend == DB_ENGINE_POSTGRESQL:
+                    deleted_rows = self.cursor.fetchall()
                 if affected_rows != 1:
                     raise EntryNotFoundError(table, data_id)
         except EntryNotFoundError as entry_not_found_error:
@@ -189,6 +268,12 @@ class DBService(object):
             log_error(
                 'db_service.py >> delete_data() >> delete_query execution: ' + error.message)
             raise DBError(table, error)
+        deleted_row = deleted_rows[0]
+        if self.write_buffer is not None:
+            # the pending update is dropped, but the row is returned as it was last seen
+            deleted_row = self.write_buffer.apply_overlay(table, valid_columns, [deleted_row])[0]
+            self.write_buffer.discard(table, data_id)
+        return deleted_row
 
     def select_data(self, table, data_id=None, exclude=None, **kwargs):
         '''
@@ -206,13 +291,12 @@ class DBService(object):
             raise InvalidTableError(table)
         valid_columns = self.get_valid_columns(table)
         if exclude:
-            columns_to_select = ', '.join(
-                list(
-                    set(valid_columns).difference(set(exclude))
-                )
+            selected_columns = list(
+                set(valid_columns).difference(set(exclude))
             )
         else:
-            columns_to_select = ', '.join(valid_columns)
+            selected_columns = valid_columns
+        columns_to_select = ', '.join(selected_columns)
 
         select_query = select_query.format(
             table=table, columns_to_select=columns_to_select)
@@ -245,6 +329,11 @@ class DBService(object):
                 select_query += ' WHERE is_active=TRUE'
         # remove new line characters from the select_query string
         select_query = select_query.replace('\n', '')
+        # queued updates can change which rows match the filters,
+        # so they are written to the database before filtering on their columns
+        if self.write_buffer is not None and \
+                self.write_buffer.has_pending_columns(table, filter_columns):
+            self.write_buffer.flush()
         try:
             with self.db_connection:  # required for auto commit/rollback
                 self.cursor.execute(select_query, filter_params)
@@ -253,6 +342,9 @@ class DBService(object):
             log_error(
                 'db_service.py >> select_data() >> select_query execution: ' + error.message)
             raise DBError(table, error)
+        if self.write_buffer is not None:
+            # show the updates that are still queued in this worker
+            db_data = self.write_buffer.apply_overlay(table, selected_columns, db_data)
         if data_id:
             try:
                 return db_data[0]
@@ -260,6 +352,102 @@ class DBService(object):
                 raise EntryNotFoundError(table, data_id)
         return db_data
 
+    def select_data_between(self, table, **kwargs):
+        '''
+        SELECT the data from 'table' whose values lie within given ranges.
+        The ranges are passed as column:(low, high) pairs via kwargs, the bounds
+        being inclusive. Ranges will be ANDED.
+        '''
+        select_query = '''
+        SELECT {columns_to_select} FROM {table} 
+        '''
+        if not self.is_valid_table(table):
+            raise InvalidTableError(table)
+        invalid_range_columns = self.get_invalid_columns(table, kwargs.keys())
+        if len(invalid_range_columns) > 0:
+            raise InvalidColumnsError(table, invalid_range_columns)
+        valid_columns = self.get_valid_columns(table)
+        select_query = select_query.format(
+            table=table, columns_to_select=', '.join(valid_columns))
+        range_columns = list(kwargs.keys())
+        conditions = ['{c} BETWEEN {p} AND {p}'.format(c=c, p=self.placeholder)
+                      for c in range_columns]
+        # if 'table' has an 'is_active' column,
+        # we make sure we select only the active data entries
+        if 'is_active' in valid_columns:
+            conditions.append('is_active=TRUE')
+        if conditions:
+            select_query += ' WHERE ' + ' AND '.join(conditions)
+        select_query = select_query.replace('\n', '')
+        range_params = []
+        for column in range_columns:
+            range_params.extend(kwargs[column])
+        # queued updates can move rows in or out of the ranges
+        if self.write_buffer is not None and \
+                self.write_buffer.has_pending_columns(table, range_columns):
+            self.write_buffer.flush()
+        try:
+            with self.db_connection:  # required for auto commit/rollback
+                self.cursor.execute(select_query, range_params)
+                db_data = self.cursor.fetchall()
+        except Exception as error:
+            log_error(
+                'db_service.py >> select_data_between() >> select_query execution: ' +
+                error.message)
+            raise DBError(table, error)
+        if self.write_buffer is not None:
+            db_data = self.write_buffer.apply_overlay(table, valid_columns, db_data)
+        return db_data
+
+    def select_data_in(self, table, **kwargs):
+        '''
+        SELECT the data from 'table' whose values are among given values, in a single query.
+        The values are passed as column:[value, ...] pairs via kwargs.
+        Conditions will be ANDED.
+        '''
+        select_query = '''
+        SELECT {columns_to_select} FROM {table} 
+        '''
+        if not self.is_valid_table(table):
+            raise InvalidTableError(table)
+        invalid_filter_columns = self.get_invalid_columns(table, kwargs.keys())
+        if len(invalid_filter_columns) > 0:
+            raise InvalidColumnsError(table, invalid_filter_columns)
+        filter_columns = list(kwargs.keys())
+        if any(len(kwargs[column]) == 0 for column in filter_columns):
+            return []  # nothing can match, and 'IN ()' is not valid SQL
+        valid_columns = self.get_valid_columns(table)
+        select_query = select_query.format(
+            table=table, columns_to_select=', '.join(valid_columns))
+        conditions = ['{c} IN ({p})'.format(c=c, p=', '.join([self.placeholder] * len(kwargs[c])))
+                      for c in filter_columns]
+        # if 'table' has an 'is_active' column,
+        # we make sure we select only the active data entries
+        if 'is_active' in valid_columns:
+            conditions.append('is_active=TRUE')
+        if conditions:
+            select_query += ' WHERE ' + ' AND '.join(conditions)
+        select_query = select_query.replace('\n', '')
+        filter_params = []
+        for column in filter_columns:
+            filter_params.extend(kwargs[column])
+        # queued updates can change which rows have the values
+        if self.write_buffer is not None and \
+                self.write_buffer.has_pending_columns(table, filter_columns):
+            self.write_buffer.flush()
+        try:
+            with self.db_connection:  # required for auto commit/rollback
+                self.cursor.execute(select_query, filter_params)
+                db_data = self.cursor.fetchall()
+        except Exception as error:
+            log_error(
+                'db_service.py >> select_data_in() >> select_query execution: ' +
+                error.message)
+            raise DBError(table, error)
+        if self.write_buffer is not None:
+            db_data = self.write_buffer.apply_overlay(table, valid_columns, db_data)
+        return db_data
+
     def search_data(self, table, column, search_key):
         '''
         Search through 'table' in the specified 'column' and return the
@@ -2,9 +2,19 @@
 Custom Errors
 '''
 from os import environ as os_environ
+from sqlite3 import DataError as SqliteDataError
+from sqlite3 import IntegrityError as SqliteIntegrityError
 
+from psycopg2 import DataError as PostgresDataError
+from psycopg2 import IntegrityError as PostgresIntegrityError
 from psycopg2 import errorcodes
 
+# errors caused by the data itself (e.g. a unique constraint violation),
+# which would fail again if the same query was retried
+DATA_ERRORS = (
+    PostgresDataError, PostgresIntegrityError, SqliteDataError, SqliteIntegrityError
+)
+
 
 class InvalidColumnsError(Exception):
     '''
@@ -22,6 +32,22 @@ class InvalidColumnsError(Exception):
         self.table = table
 
 
+class InvalidValuesError(Exception):
+    '''
+    Indicates that the value(s) of column(s) are not valid for a particular database table.
+    The name of the table is as given by 'table' attribute.
+    The column(s) are as given by the 'columns' attribute.
+    '''
+
+    def __init__(self, table, invalid_columns):
+        super(InvalidValuesError, self).__init__("")
+        invalid_columns_str = ', '.join(invalid_columns)
+        self.message = "Invalid value(s) for the column(s) {} of the table '{}'".format(
+            invalid_columns_str, table)
+        self.columns = invalid_columns
+        self.table = table
+
+
 class DBError(Exception):
     '''
     A wrapper class for errors raised as a result of db operations.
@@ -31,6 +57,8 @@ class DBError(Exception):
     https://www.postgresql.org/docs/current/static/errcodes-appendix.html#ERRCODES-TABLE
     The table for which the error occurred is stored in DBError.table
     The error code resulting from the exception is stored in DBError.error_code
+    DBError.is_data_error is True if the error is caused by the data itself rather
+    than by e.g. a lost connection, so retrying the same query is pointless
     '''
 
     def __init__(self, table, postgres_error):
@@ -39,8 +67,9 @@ class DBError(Exception):
             'FLASK_DEBUG') else 'Internal server db error. Actual message has been logged on server'
         try:
             self.error_code = errorcodes.lookup(postgres_error.pgcode[:2])
-        except AttributeError:
+        except (AttributeError, TypeError):  # not a postgres error, or no pgcode (e.g. connection errors)
             self.error_code = 'Not a postgres error'
+        self.is_data_error = isinstance(postgres_error, DATA_ERRORS)
         self.table = table
 
 
@@ -70,3 +99,31 @@ class InvalidTableError(Exception):
         super(InvalidTableError, self).__init__(
             "The table {} was not found in the database".format(table))
         self.table = table
+
+
+class SnapshotNotReadyError(Exception):
+    '''
+    This is the error thrown when a table snapshot is requested before it is built.
+    The request can be retried once the build, which is running in the background, is done.
+    The name of the table is stored in SnapshotNotReadyError.table
+    '''
+
+    def __init__(self, table):
+        super(SnapshotNotReadyError, self).__init__("")
+        self.message = "The snapshot of the {} table is being built, please retry shortly".format(
+            table)
+        self.table = table
+
+
+class IndexNotReadyError(Exception):
+    '''
+    This is the error thrown when an in-memory index is searched before it is built.
+    The search can be retried once the build, which is running in the background, is done.
+    The name of the indexed table is stored in IndexNotReadyError.table
+    '''
+
+    def __init__(self, table):
+        super(IndexNotReadyError, self).__init__("")
+        self.message = "The index of the {} table is being built, please retry shortly".format(
+            table)
+        self.table = table
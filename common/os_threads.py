@@ -0,0 +1,83 @@
+'''
+Threads, locks and sleep of the OS, even under the gevent workers, where
+'thread' and 'time' are monkey patched to greenlets. A greenlet doing CPU bound
+work blocks every other request of its worker, while an OS thread runs alongside them.
+'''
+from logging import error as log_error
+from time import time
+
+try:
+    import thread as _thread_module
+except ImportError:
+    import _thread as _thread_module
+
+
+def _get_original(module, name):
+    '''
+    Return the un-patched 'name' from 'module'
+    '''
+    try:
+        from gevent.monkey import get_original
+    except ImportError:
+        return getattr(__import__(module), name)
+    return get_original(module, name)
+
+
+start_new_thread = _get_original(_thread_module.__name__, 'start_new_thread')
+get_ident = _get_original(_thread_module.__name__, 'get_ident')
+allocate_lock = _get_original(_thread_module.__name__, 'allocate_lock')
+sleep = _get_original('time', 'sleep')
+
+
+class DebouncedTask(object):
+    '''
+    Runs 'function' in an OS thread 'delay' seconds after the last call to
+    schedule(), but never more than 'max_delay' seconds (10 * delay by default)
+    after the first call of a burst, so a steady stream of calls cannot
+    postpone it forever. The calls made while 'function' runs schedule another run.
+    '''
+
+    def __init__(self, function, delay, max_delay=None):
+        self.function = function
+        self.delay = delay
+        self.max_delay = 10 * delay if max_delay is None else max_delay
+        self._lock = allocate_lock()
+        self._due_at = None  # when the next run is due, None if none is scheduled
+        self._deadline = None  # latest time the next run can be postponed to
+        self._running = False  # True while the thread of the task is alive
+
+    @property
+    def due_at(self):
+        return self._due_at
+
+    def schedule(self, delay=None):
+        '''
+        (Re)schedule the run of 'function' in 'delay' seconds ('delay' by default)
+        '''
+        delay = self.delay if delay is None else delay
+        with self._lock:
+            now = time()
+            if self._deadline is None:
+                self._deadline = now + self.max_delay
+            self._due_at = max(now, min(now + delay, self._deadline))
+            if not self._running:
+                self._running = True
+                start_new_thread(self._run, ())
+
+    def _run(self):
+        while True:
+            with self._lock:
+                if self._due_at is None:
+                    self._running = False
+                    return
+                wait = self._due_at - time()
+                if wait <= 0:
+                    self._due_at = self._deadline = None
+            if wait > 0:
+                # in short steps, so an earlier schedule() is not missed
+                sleep(min(wait, 0.1))
+                continue
+            try:
+                self.function()
+            except Exception as error:
+                log_error('os_threads.py >> DebouncedTask._run(): ' + str(error))
@@ -0,0 +1,272 @@
+'''
+On-demand sampling profiler for api requests.
+A profiled request is sampled from a separate OS thread, so the request itself
+runs unmodified. The whole WSGI dispatch of the request is sampled, so the
+time spent in flask itself is measured along with the view. The samples are stored as collapsed stacks (the input format of
+flamegraph.pl / speedscope) in a bounded on-disk ring buffer.
+NB: under the gevent workers, samples taken while a request waits on io
+may show other requests running on the same thread.
+'''
+from functools import wraps
+from logging import error as log_error
+from os import getpid, listdir, makedirs, remove, rename
+from os import path as os_path
+from random import random
+from re import compile as compile_regex
+from sys import _current_frames
+from time import time
+
+from flask import json, request
+from werkzeug.exceptions import HTTPException
+
+# under the gevent workers, the sampler must be an OS thread to run alongside
+# the request being sampled
+from common.os_threads import allocate_lock as _allocate_lock
+from common.os_threads import get_ident as _get_ident
+from common.os_threads import sleep as _sleep
+from common.os_threads import start_new_thread as _start_new_thread
+
+# categories that the time of a request is attributed to.
+# every sample is attributed to the category of the innermost frame that matches
+CATEGORY_SQL = 'sql'
+CATEGORY_SERIALISATION = 'serialisation'
+CATEGORY_FLASK = 'flask'
+CATEGORY_VIEW = 'view'
+CATEGORY_OTHER = 'other'
+_CATEGORY_PATTERNS = [
+    (CATEGORY_SQL, compile_regex(r'common[\\/]db_service\.py$|[\\/](psycopg2|sqlite3)[\\/]')),
+    (CATEGORY_SERIALISATION, compile_regex(r'[\\/](simplejson|json)([\\/]|\.py)')),
+    (CATEGORY_FLASK, compile_regex(r'[\\/](flask|werkzeug)[\\/]')),
+    (CATEGORY_VIEW, compile_regex(r'api[\\/]views[\\/]')),
+]
+
+PROFILE_ID_PATTERN = compile_regex(r'^[0-9]+-[0-9]+$')
+
+
+def categorise_stack(filenames):
+    '''
+    Return the category of a sampled stack, given the file names of its
+    frames from the outermost to the innermost frame
+    '''
+    for filename in reversed(filenames):
+        for category, pattern in _CATEGORY_PATTERNS:
+            if pattern.search(filename):
+                return category
+    return CATEGORY_OTHER
+
+
+class SamplingProfiler(object):
+    '''
+    Samples the stack of the thread with id 'thread_id' every 'interval' seconds
+    until stop() is called.
+    The stacks are counted in 'counts' as collapsed stacks, mapping
+    'outer;...;inner' to the number of times the stack was seen.
+    '''
+
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.counts = {}
+        self.breakdown = {}
+        self._running = False
+        self._lock = _allocate_lock()
+
+    def start(self):
+        self._running = True
+        _start_new_thread(self._run, ())
+
+    def stop(self):
+        with self._lock:
+            self._running = False
+
+    def _run(self):
+        while True:
+            _sleep(self.interval)
+            with self._lock:
+                if not self._running:
+                    return
+                frame = _current_frames().get(self.thread_id)
+                if frame is not None:
+                    self._record(frame)
+
+    def _record(self, frame):
+        labels = []
+        filenames = []
+        while frame is not None:
+            code = frame.f_code
+            labels.append('{} ({}:{})'.format(
+                code.co_name, os_path.basename(code.co_filename), code.co_firstlineno))
+            filenames.append(code.co_filename)
+            frame = frame.f_back
+        labels.reverse()
+        filenames.reverse()
+        stack = ';'.join(labels)
+        self.counts[stack] = self.counts.get(stack, 0) + 1
+        category = categorise_stack(filenames)
+        self.breakdown[category] = self.breakdown.get(category, 0) + 1
+
+    def collapsed(self):
+        '''
+        Return the samples as collapsed stacks, one 'stack count' per line
+        '''
+        return '\n'.join(
+            '{} {}'.format(stack, count) for stack, count in sorted(self.counts.items()))
+
+
+class ProfileStore(object):
+    '''
+    Keeps the last 'max_profiles' request profiles as JSON files in 'profile_dir'.
+    The oldest profiles are removed as new ones are saved.
+    '''
+
+    def __init__(self, profile_dir, max_profiles):
+        if max_profiles < 1:
+            raise ValueError('max_profiles must be at least 1, got {}'.format(max_profiles))
+        self.profile_dir = profile_dir
+        self.max_profiles = max_profiles
+
+    def _profile_path(self, profile_id):
+        return os_path.join(self.profile_dir, '{}.json'.format(profile_id))
+
+    def _profile_ids(self):
+        if not os_path.isdir(self.profile_dir):
+            return []
+        profile_ids = [f[:-len('.json')] for f in listdir(self.profile_dir)
+                       if f.endswith('.json')]
+        # the ids start with a zero padded timestamp, so they sort oldest first
+        return sorted(p for p in profile_ids if PROFILE_ID_PATTERN.match(p))
+
+    def save(self, profile):
+        '''
+        Save 'profile' and return its id
+        '''
+        if not os_path.isdir(self.profile_dir):
+            makedirs(self.profile_dir)
+        profile_id = '{:020d}-{}'.format(int(time() * 1000000), getpid())
+        profile['id'] = profile_id
+        # written to a temporary file first, so that other workers never read
+        # a partially written profile
+        profile_path = self._profile_path(profile_id)
+        tmp_path = '{}.tmp'.format(profile_path)
+        with open(tmp_path, 'w') as profile_file:
+            profile_file.write(json.dumps(profile))
+        rename(tmp_path, profile_path)
+        stale_ids = self._profile_ids()[:-self.max_profiles]
+        for stale_id in stale_ids:
+            try:
+                remove(self._profile_path(stale_id))
+            except OSError:
+                pass
+        return profile_id
+
+    def get(self, profile_id):
+        '''
+        Return the profile with the id 'profile_id', or None if it does not exist
+        '''
+        if not PROFILE_ID_PATTERN.match(profile_id):
+            return None
+        try:
+            with open(self._profile_path(profile_id), 'r') as profile_file:
+                return json.loads(profile_file.read())
+        except (IOError, ValueError):
+            return None
+
+    def list(self):
+        '''
+        Return all stored profiles, newest first, without their stacks
+        '''
+        profiles = []
+        for profile_id in reversed(self._profile_ids()):
+            profile = self.get(profile_id)
+            if profile is not None:
+                profile.pop('collapsed', None)
+                profiles.append(profile)
+        return profiles
+
+
+class RequestProfiler(object):
+    '''
+    Decides which requests are profiled and stores their profiles in 'store'.
+    A request is profiled if it carries the header 'header' with the value 'token',
+    or otherwise with the probability 'sample_rate'.
+    Profiling on demand is disabled when no 'token' is configured.
+    The requests whose path starts with one of 'ignored_paths' (e.g. the
+    requests reading the profiles) are never profiled.
+    '''
+    header = 'X-Profile'
+
+    def __init__(self, store, token=None, sample_rate=0.0, interval=0.005, ignored_paths=()):
+        self.store = store
+        self.token = token
+        self.sample_rate = sample_rate
+        self.interval = interval
+        self.ignored_paths = tuple(ignored_paths)
+
+    def _is_token(self, value):
+        return bool(self.token) and value == self.token
+
+    def is_authorised(self):
+        '''
+        Returns True if the current request carries the profiling token
+        '''
+        return self._is_token(request.headers.get(self.header))
+
+    def should_profile(self, environ):
+        '''
+        Returns True if the request of the WSGI 'environ' must be profiled
+        '''
+        if environ.get('PATH_INFO', '').startswith(self.ignored_paths):
+            return False
+        header_key = 'HTTP_' + self.header.upper().replace('-', '_')
+        return self._is_token(environ.get(header_key)) or (
+            self.sample_rate > 0 and random() < self.sample_rate)
+
+    def profile_app(self, app):
+        '''
+        Return the WSGI application of the flask 'app', dispatching the requests
+        selected by should_profile() under a SamplingProfiler. The whole dispatch
+        is profiled: routing, the request context, the view, the response
+        finalisation and the teardown handlers.
+        '''
+        wsgi_app = app.wsgi_app
+
+        @wraps(wsgi_app)
+        def profiled_wsgi_app(environ, start_response):
+            if not self.should_profile(environ):
+                return wsgi_app(environ, start_response)
+            profiler = SamplingProfiler(_get_ident(), self.interval)
+            started_at = time()
+            profiler.start()
+            try:
+                return wsgi_app(environ, start_response)
+            finally:
+                profiler.stop()
+                duration = time() - started_at
+                path = environ.get('PATH_INFO', '')
+                if environ.get('QUERY_STRING'):
+                    path += '?' + environ['QUERY_STRING']
+                try:
+                    self.store.save({
+                        'method': environ.get('REQUEST_METHOD'),
+                        'path': path,
+                        'endpoint': _endpoint(app, environ),
+                        'started_at': started_at,
+                        'duration_ms': round(duration * 1000, 3),
+                        'interval_ms': self.interval * 1000,
+                        'samples': sum(profiler.counts.values()),
+                        'breakdown': profiler.breakdown,
+                        'collapsed': profiler.collapsed(),
+                    })
+                except (IOError, OSError) as error:
+                    log_error('profiler.py >> profile_app(): ' + str(error))
+        return profiled_wsgi_app
+
+
+def _endpoint(app, environ):
+    '''
+    Return the endpoint of the flask 'app' that the request of 'environ' is routed to
+    '''
+    try:
+        return app.url_map.bind_to_environ(environ).match()[0]
+    except HTTPException:
+        return None
@@ -0,0 +1,159 @@
+'''
+Prebuilt, versioned and gzip-compressed snapshots of whole database tables.
+A snapshot is rebuilt in the background (debounced, in an OS thread) whenever
+the table changes, so bulk downloads can be served straight from disk.
+'''
+from gzip import GzipFile
+from hashlib import sha1
+from io import BytesIO
+from logging import error as log_error
+from mmap import ACCESS_READ, mmap
+from os import getpid, listdir, makedirs, remove, rename
+from os import path as os_path
+
+from flask import json
+
+from common.exceptions import DBError, SnapshotNotReadyError
+from common.os_threads import DebouncedTask, allocate_lock
+
+
+class TableSnapshot(object):
+    '''
+    Maintains a gzip-compressed JSON dump of all the entries of 'table'.
+    Every build is written to '<snapshot_dir>/<table>-<version>.json.gz', where
+    'version' is derived from the content of the dump. The name of the current
+    snapshot file is kept in '<snapshot_dir>/<table>.latest' so that all the
+    worker processes serve the same version.
+    'db_service_factory' must return a new DBService each time it is called,
+    since the snapshot is built outside of the request thread.
+    Rebuilds are debounced by 'rebuild_delay' seconds, but never postponed
+    more than 'max_rebuild_delay' seconds (10 * rebuild_delay by default)
+    after the first write of a burst.
+    '''
+    # attempts of current() to open the snapshot file, which another
+    # worker may remove between reading the pointer and opening it
+    open_attempts = 3
+
+    def __init__(self, table, db_service_factory, snapshot_dir, rebuild_delay=2.0,
+                 max_rebuild_delay=None):
+        self.table = table
+        self.db_service_factory = db_service_factory
+        self.snapshot_dir = snapshot_dir
+        self.rebuild_delay = rebuild_delay
+        self._rebuild_task = DebouncedTask(self.rebuild, rebuild_delay, max_rebuild_delay)
+        self._build_lock = allocate_lock()
+        self._mapped = (None, None)  # (file name, mmap) of the last file served
+
+    @property
+    def pointer_path(self):
+        '''
+        Path of the file holding the name of the current snapshot file
+        '''
+        return os_path.join(self.snapshot_dir, '{}.latest'.format(self.table))
+
+    def schedule_rebuild(self):
+        '''
+        Rebuild the snapshot in the background after 'rebuild_delay' seconds.
+        Calls made while a rebuild is pending push the rebuild further, so a burst
+        of writes results in a single rebuild, up to 'max_rebuild_delay' seconds
+        after the burst started.
+        '''
+        self._rebuild_task.schedule()
+
+    def start(self):
+        '''
+        Build the snapshot in the background right away if none exists yet
+        '''
+        if self._read_pointer() is None:
+            self._rebuild_task.schedule(0)
+
+    def rebuild(self):
+        '''
+        Dump the table, compress it and atomically make it the current snapshot.
+        Returns the version of the new snapshot.
+        Raises DBError if the table cannot be read.
+        '''
+        with self._build_lock:
+            try:
+                db_service = self.db_service_factory()
+                try:
+                    db_data = db_service.select_data(self.table)
+                finally:
+                    db_service.db_connection.close()
+            except DBError:
+                raise
+            except Exception as error:
+                # e.g. the database connection could not be opened
+                log_error('snapshot.py >> rebuild(): ' + str(error))
+                raise DBError(self.table, error)
+            payload = json.dumps(db_data)
+            if not isinstance(payload, bytes):
+                payload = payload.encode('utf-8')
+            version = sha1(payload).hexdigest()[:16]
+            file_name = '{}-{}.json.gz'.format(self.table, version)
+            if not os_path.isdir(self.snapshot_dir):
+                makedirs(self.snapshot_dir)
+            file_path = os_path.join(self.snapshot_dir, file_name)
+            if not os_path.exists(file_path):
+                buf = BytesIO()
+                # mtime is fixed so that the same content always gives the same bytes
+                with GzipFile(fileobj=buf, mode='wb', compresslevel=6, mtime=0) as gzip_file:
+                    gzip_file.write(payload)
+                self._write_atomically(file_path, buf.getvalue())
+            self._write_atomically(self.pointer_path, file_name.encode('utf-8'))
+            self._remove_stale_files(keep=file_name)
+        return version
+
+    def current(self):
+        '''
+        Return (version, mmap) of the current snapshot.
+        The returned mmap is read-only and must not be closed by the caller.
+        Raises SnapshotNotReadyError if no snapshot is built yet, and starts building it.
+        '''
+        for _ in range(self.open_attempts):
+            file_name = self._read_pointer()
+            if file_name is None:
+                self._rebuild_task.schedule(0)
+                raise SnapshotNotReadyError(self.table)
+            mapped_name, mapped = self._mapped
+            if mapped_name != file_name:
+                try:
+                    with open(os_path.join(self.snapshot_dir, file_name), 'rb') as snapshot_file:
+                        mapped = mmap(snapshot_file.fileno(), 0, access=ACCESS_READ)
+                except (IOError, OSError):
+                    # replaced by a newer snapshot since the pointer was read
+                    continue
+                self._mapped = (file_name, mapped)
+            version = file_name[len(self.table) + 1:-len('.json.gz')]
+            return version, mapped
+        raise SnapshotNotReadyError(self.table)
+
+    def _read_pointer(self):
+        try:
+            with open(self.pointer_path, 'rb') as pointer_file:
+                file_name = pointer_file.read().decode('utf-8').strip()
+        except IOError:
+            return None
+        if not os_path.exists(os_path.join(self.snapshot_dir, file_name)):
+            return None
+        return file_name
+
+    def _write_atomically(self, file_path, content):
+        tmp_path = '{}.{}.tmp'.format(file_path, getpid())
+        with open(tmp_path, 'wb') as tmp_file:
+            tmp_file.write(content)
+        rename(tmp_path, file_path)
+
+    def _remove_stale_files(self, keep):
+        '''
+        Delete the snapshot files of 'table' other than 'keep'.
+        Files that are already memory-mapped stay readable after removal.
+        '''
+        prefix = '{}-'.format(self.table)
+        for file_name in listdir(self.snapshot_dir):
+            if file_name.startswith(prefix) and file_name.endswith('.json.gz') \
+                    and file_name != keep:
+                try:
+                    remove(os_path.join(self.snapshot_dir, file_name))
+                except OSError:
+                    pass
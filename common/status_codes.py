@@ -7,11 +7,18 @@ and not part of the standard HTTP status codes
 # success statius codes
 STATUS_OK = 200
 STATUS_CREATED = 201
+STATUS_PARTIAL_CONTENT = 206
+
+# redirection status codes
+STATUS_NOT_MODIFIED = 304
 
 # client error status codes
 STATUS_INVALID_INPUT = 451
+STATUS_FORBIDDEN = 403
 STATUS_NOT_FOUND = 404
 STATUS_NO_INPUT = 450
+STATUS_RANGE_NOT_SATISFIABLE = 416
 
 # server-side errors status codes
 STATUS_INTERNAL_ERROR = 500
+STATUS_SERVICE_UNAVAILABLE = 503
@@ -0,0 +1,507 @@
+'''
+Mapbox Vector Tiles (https://github.com/mapbox/vector-tile-spec/tree/master/2.1)
+of point data, with a bounded cache of the encoded tiles and a store of the
+low zoom tiles shared by the worker processes.
+Only the subset of protobuf needed to encode point features is implemented here,
+so no protobuf library is required.
+'''
+from collections import OrderedDict
+from itertools import count
+from logging import error as log_error
+from math import atan, cos, degrees, floor, log, pi, radians, sinh, tan
+from os import getpid, makedirs, rename
+from os import path as os_path
+from struct import pack
+from threading import Lock
+from time import time
+
+from common.os_threads import DebouncedTask, allocate_lock
+
+# web mercator cannot represent the poles, so latitudes are limited to this value
+MAX_LATITUDE = 85.0511287798
+MAX_ZOOM = 22
+
+try:
+    long_type = long
+    text_type = unicode
+except NameError:
+    long_type = int
+    text_type = str
+
+# protobuf wire types
+_WIRE_VARINT = 0
+_WIRE_64BIT = 1
+_WIRE_LENGTH_DELIMITED = 2
+
+# geometry command of a MoveTo with 1 point: (command id 1) | (count 1 << 3)
+_MOVE_TO_ONE_POINT = 9
+_GEOM_TYPE_POINT = 1
+
+
+def _varint(value):
+    data = bytearray()
+    while True:
+        byte = value & 0x7f
+        value >>= 7
+        if value:
+            data.append(byte | 0x80)
+        else:
+            data.append(byte)
+            return data
+
+
+def _zigzag(value):
+    return (value << 1) ^ (value >> 63)
+
+
+def _field(field_number, wire_type):
+    return _varint((field_number << 3) | wire_type)
+
+
+def _length_delimited(field_number, payload):
+    return _field(field_number, _WIRE_LENGTH_DELIMITED) + _varint(len(payload)) + payload
+
+
+def _varint_field(field_number, value):
+    return _field(field_number, _WIRE_VARINT) + _varint(value)
+
+
+def _packed(field_number, values):
+    payload = bytearray()
+    for value in values:
+        payload += _varint(value)
+    return _length_delimited(field_number, payload)
+
+
+def _encode_value(value):
+    '''
+    Encode a feature property as a vector tile 'Value' message
+    '''
+    if isinstance(value, bool):
+        return _varint_field(7, int(value))
+    if isinstance(value, (int, long_type)) and value >= 0:
+        return _varint_field(5, value)
+    if isinstance(value, (int, long_type)):
+        return _varint_field(6, _zigzag(value))
+    if isinstance(value, float):
+        return _field(3, _WIRE_64BIT) + bytearray(pack('<d', value))
+    if not isinstance(value, text_type):
+        value = text_type(value)
+    return _length_delimited(1, bytearray(value.encode('utf-8')))
+
+
+def encode_point_layer(layer_name, features, extent=4096):
+    '''
+    Return the bytes of a vector tile with a single layer named 'layer_name'.
+    'features' is a list of (feature_id, x, y, properties), where x and y are
+    tile coordinates in [0, extent) and properties is a dict.
+    '''
+    keys = OrderedDict()
+    values = OrderedDict()
+    layer = bytearray()
+    layer += _varint_field(15, 2)  # version
+    layer += _length_delimited(1, bytearray(layer_name.encode('utf-8')))
+    for feature_id, x, y, properties in features:
+        tags = []
+        for key, value in sorted(properties.items()):
+            if value is None:
+                continue
+            # 'value' is typed in the dict key, so that 1 and '1' stay distinct
+            value_key = (type(value).__name__, value)
+            tags.append(keys.setdefault(key, len(keys)))
+            tags.append(values.setdefault(value_key, len(values)))
+        feature = bytearray()
+        if feature_id is not None:
+            feature += _varint_field(1, feature_id)
+        feature += _packed(2, tags)
+        feature += _varint_field(3, _GEOM_TYPE_POINT)
+        feature += _packed(4, [_MOVE_TO_ONE_POINT, _zigzag(x), _zigzag(y)])
+        layer += _length_delimited(2, feature)
+    for key in keys:
+        layer += _length_delimited(3, bytearray(key.encode('utf-8')))
+    for _, value in values:
+        layer += _length_delimited(4, _encode_value(value))
+    layer += _varint_field(5, extent)
+    return bytes(_length_delimited(3, layer))
+
+
+def lnglat_to_tile(lng, lat, zoom):
+    '''
+    Return the fractional (x, y) position of a point in the tile grid of 'zoom'
+    '''
+    tiles = 2 ** zoom
+    lat = max(-MAX_LATITUDE, min(MAX_LATITUDE, lat))
+    x = (lng + 180.0) / 360.0 * tiles
+    y = (1.0 - log(tan(radians(lat)) + 1.0 / cos(radians(lat))) / pi) / 2.0 * tiles
+    return x, y
+
+
+def tile_to_lnglat(x, y, zoom):
+    '''
+    Return the (lng, lat) of the north-west corner of the tile (x, y) of 'zoom'.
+    Fractional tile positions are allowed.
+    '''
+    tiles = 2 ** zoom
+    lng = x / float(tiles) * 360.0 - 180.0
+    lat = degrees(atan(sinh(pi * (1 - 2 * y / float(tiles)))))
+    return lng, lat
+
+
+def is_valid_tile(z, x, y):
+    return 0 <= z <= MAX_ZOOM and 0 <= x < 2 ** z and 0 <= y < 2 ** z
+
+
+class TileCache(object):
+    '''
+    LRU cache of at most 'max_size' encoded tiles, keyed by (z, x, y).
+    Tiles older than 'max_age' seconds are rebuilt, so changes made through
+    other worker processes show up eventually.
+    '''
+
+    def __init__(self, max_size=4096, max_age=60):
+        self.max_size = max_size
+        self.max_age = max_age
+        # incremented by every invalidation
+        self.generation = 0
+        self._tiles = OrderedDict()
+        # generation of the last invalidation of each tile, for the last 'max_size' tiles
+        self._invalidated = OrderedDict()
+        # newest generation that was dropped from '_invalidated'
+        self._forgotten_generation = 0
+        self._lock = Lock()
+
+    def get(self, z, x, y):
+        '''
+        Return the cached tile, or None if it is not cached
+        '''
+        key = (z, x, y)
+        with self._lock:
+            entry = self._tiles.pop(key, None)
+            if entry is None:
+                return None
+            created_at, tile = entry
+            if time() - created_at > self.max_age:
+                return None
+            # re-insert the tile, to mark it as the most recently used
+            self._tiles[key] = entry
+            return tile
+
+    def put(self, z, x, y, tile, generation=None):
+        '''
+        Cache 'tile'. If 'generation' is given, the tile is only cached if it was
+        not invalidated since that generation, as it may have been built from stale data
+        '''
+        key = (z, x, y)
+        with self._lock:
+            if generation is not None and (
+                    generation < self._forgotten_generation or
+                    self._invalidated.get(key, 0) > generation):
+                return
+            self._tiles.pop(key, None)
+            self._tiles[key] = (time(), tile)
+            while len(self._tiles) > self.max_size:
+                self._tiles.popitem(last=False)
+
+    def invalidate(self, z, x, y):
+        key = (z, x, y)
+        with self._lock:
+            self.generation += 1
+            self._tiles.pop(key, None)
+            self._invalidated.pop(key, None)
+            self._invalidated[key] = self.generation
+            while len(self._invalidated) > self.max_size:
+                _, self._forgotten_generation = self._invalidated.popitem(last=False)
+
+
+class TileStore(object):
+    '''
+    Encoded tiles from zoom 0 to 'max_zoom', stored as files in 'tile_dir' so
+    that they are shared by all the worker processes and survive their restarts.
+    '''
+
+    def __init__(self, tile_dir, max_zoom):
+        self.tile_dir = tile_dir
+        self.max_zoom = max_zoom
+        self._tmp_ids = count()
+
+    def handles(self, z):
+        return z <= self.max_zoom
+
+    def _tile_path(self, z, x, y):
+        return os_path.join(self.tile_dir, str(z), str(x), '{}.pbf'.format(y))
+
+    def get(self, z, x, y):
+        '''
+        Return the stored tile, or None if it is not stored
+        '''
+        try:
+            with open(self._tile_path(z, x, y), 'rb') as tile_file:
+                return tile_file.read()
+        except IOError:
+            return None
+
+    def put(self, z, x, y, tile, built_since):
+        '''
+        Store 'tile', built from data read after the time 'built_since'.
+        The tile is not stored if a tile built from newer data is stored already
+        (e.g. by another worker).
+        '''
+        tile_path = self._tile_path(z, x, y)
+        try:
+            if os_path.getmtime(tile_path) > built_since:
+                return
+        except OSError:
+            pass  # the tile is not stored yet
+        self._write(tile_path, tile)
+
+    def _write(self, tile_path, content):
+        try:
+            tile_dir = os_path.dirname(tile_path)
+            if not os_path.isdir(tile_dir):
+                try:
+                    makedirs(tile_dir)
+                except OSError:
+                    # another worker may just have created it
+                    if not os_path.isdir(tile_dir):
+                        raise
+            tmp_path = '{}.{}.{}.tmp'.format(tile_path, getpid(), next(self._tmp_ids))
+            with open(tmp_path, 'wb') as tmp_file:
+                tmp_file.write(content)
+            rename(tmp_path, tile_path)
+        except (IOError, OSError) as error:
+            log_error('vector_tiles.py >> TileStore._write(): ' + str(error))
+
+
+class PointTiles(object):
+    '''
+    Builds the vector tiles of the rows of 'table', located by the 'lat_column'
+    and 'long_column' columns. The tiles handled by the optional TileStore 'store'
+    are kept in it, the others are cached in the TileCache 'cache'.
+    The stored tiles cover many rows and are slow to build, so when they are
+    invalidated they keep being served while they are rebuilt in the background,
+    'refresh_delay' seconds after the last invalidation (debounced), with a
+    DBService from 'db_service_factory'.
+    'columns' are the columns of 'table', in the order they are selected in.
+    Each row becomes a point feature with 'id_column' as id and
+    'property_columns' as properties. Points within 'buffer' (in tile
+    coordinates) of the edge of a tile are also included in it, so that
+    markers are not cut at the tile edges.
+    The points within the same 'cluster_size' square (in tile coordinates) are
+    merged into a single feature, so that a tile holds at most
+    (extent / cluster_size) ** 2 features however many rows it covers.
+    '''
+
+    def __init__(self, table, columns, cache, store=None, db_service_factory=None,
+                 refresh_delay=2.0, id_column=None, property_columns=(), lat_column='lat',
+                 long_column='long', layer_name=None, extent=4096, buffer=64,
+                 cluster_size=64):
+        self.table = table
+        self.columns = columns
+        self.cache = cache
+        self.store = store
+        self.db_service_factory = db_service_factory
+        # the stored tiles to rebuild, and the lock guarding them
+        self._dirty = set()
+        self._dirty_lock = allocate_lock()
+        self._refresh_task = DebouncedTask(self.refresh, refresh_delay)
+        self.id_column = id_column
+        self.property_columns = property_columns
+        self.lat_column = lat_column
+        self.long_column = long_column
+        self.layer_name = layer_name or table
+        self.extent = extent
+        self.buffer = buffer
+        self.cluster_size = cluster_size
+
+    def _value(self, row, column):
+        if isinstance(row, dict):
+            return row[column]
+        return row[self.columns.index(column)]
+
+    def _location(self, row):
+        '''
+        Return (lng, lat) of 'row' as floats, or None if it cannot be shown on a map
+        '''
+        try:
+            lng = float(self._value(row, self.long_column))
+            lat = float(self._value(row, self.lat_column))
+        except (TypeError, ValueError):
+            return None
+        if not -180 <= lng <= 180 or not -MAX_LATITUDE <= lat <= MAX_LATITUDE:
+            return None
+        return lng, lat
+
+    def _feature(self, row, x, y):
+        feature_id = self._value(row, self.id_column) if self.id_column else None
+        properties = dict(
+            (column, self._value(row, column)) for column in self.property_columns)
+        return (feature_id, x, y, properties)
+
+    def _tiles_covering(self, lng, lat, z):
+        '''
+        Return the (x, y, tile_x, tile_y) of the tiles of zoom 'z' that include
+        the point, with tile_x/tile_y the position of the point within the tile
+        '''
+        tile_x, tile_y = lnglat_to_tile(lng, lat, z)
+        margin = self.buffer / float(self.extent)
+        tiles = 2 ** z
+        covering = []
+        for x in set([int(floor(tile_x - margin)), int(floor(tile_x + margin))]):
+            for y in set([int(floor(tile_y - margin)), int(floor(tile_y + margin))]):
+                if 0 <= x < tiles and 0 <= y < tiles:
+                    covering.append((x, y, int(round((tile_x - x) * self.extent)),
+                                     int(round((tile_y - y) * self.extent))))
+        return covering
+
+    def _encode(self, features):
+        '''
+        Encode the features of a tile, merging the ones in the same cluster
+        square into a point at their centre, with the number of merged
+        features as its 'point_count' property
+        '''
+        squares = OrderedDict()
+        for feature in features:
+            square = (feature[1] // self.cluster_size, feature[2] // self.cluster_size)
+            squares.setdefault(square, []).append(feature)
+        clustered = []
+        for square_features in squares.values():
+            point_count = len(square_features)
+            if point_count == 1:
+                clustered.append(square_features[0])
+                continue
+            x = int(round(sum(f[1] for f in square_features) / float(point_count)))
+            y = int(round(sum(f[2] for f in square_features) / float(point_count)))
+            clustered.append((None, x, y, {'point_count': point_count}))
+        return encode_point_layer(self.layer_name, clustered, self.extent)
+
+    def _build_tile(self, db_service, z, x, y):
+        margin = self.buffer / float(self.extent)
+        west, north = tile_to_lnglat(x - margin, y - margin, z)
+        east, south = tile_to_lnglat(x + 1 + margin, y + 1 + margin, z)
+        db_data = db_service.select_data_between(
+            self.table, **{self.lat_column: (south, north), self.long_column: (west, east)})
+        features = []
+        for row in db_data:
+            location = self._location(row)
+            if location is None:
+                continue
+            for tile_x, tile_y, point_x, point_y in self._tiles_covering(location[0], location[1], z):
+                if (tile_x, tile_y) == (x, y):
+                    features.append(self._feature(row, point_x, point_y))
+        return self._encode(features)
+
+    def get_tile(self, db_service, z, x, y):
+        '''
+        Return the encoded tile (z, x, y), building it if it is not stored or cached
+        '''
+        if self.store is not None and self.store.handles(z):
+            tile = self.store.get(z, x, y)
+            if tile is None:
+                built_since = time()
+                tile = self._build_tile(db_service, z, x, y)
+                self.store.put(z, x, y, tile, built_since)
+            return tile
+        tile = self.cache.get(z, x, y)
+        if tile is None:
+            generation = self.cache.generation
+            tile = self._build_tile(db_service, z, x, y)
+            self.cache.put(z, x, y, tile, generation=generation)
+        return tile
+
+    def shows_columns(self, columns):
+        '''
+        Returns True if changing 'columns' of a row can change the tiles that show it
+        '''
+        shown_columns = set(self.property_columns)
+        shown_columns.update([self.lat_column, self.long_column])
+        if self.id_column:
+            shown_columns.add(self.id_column)
+        return len(shown_columns.intersection(columns)) > 0
+
+    def invalidate_row(self, row):
+        '''
+        Remove the cached tiles, at all zoom levels, that show 'row'.
+        The stored tiles that show it are rebuilt in the background.
+        '''
+        location = self._location(row)
+        if location is None:
+            return
+        dirty = []
+        for z in range(MAX_ZOOM + 1):
+            for x, y, _, _ in self._tiles_covering(location[0], location[1], z):
+                if self.store is not None and self.store.handles(z):
+                    dirty.append((z, x, y))
+                else:
+                    self.cache.invalidate(z, x, y)
+        if dirty:
+            with self._dirty_lock:
+                self._dirty.update(dirty)
+            self._refresh_task.schedule()
+
+    def invalidate_update(self, row, new_data):
+        '''
+        Remove the stored and cached tiles that show 'row', before or after it is
+        updated with the column:new_value pairs of 'new_data'
+        '''
+        self.invalidate_row(row)
+        updated_row = dict((column, self._value(row, column)) for column in self.columns)
+        updated_row.update(new_data)
+        self.invalidate_row(updated_row)
+
+    def _build_stored_tiles(self, db_service, tiles=None):
+        '''
+        Build the stored tiles 'tiles' ((z, x, y) of any zoom handled by the store,
+        all the non-empty ones if None) with a single query, and write them to the
+        store. Returns the number of tiles written.
+        '''
+        built_since = time()
+        db_data = db_service.select_data(self.table)
+        zooms = range(self.store.max_zoom + 1)
+        if tiles is not None:
+            zooms = sorted(set(z for z, _, _ in tiles))
+        tile_count = 0
+        for z in zooms:
+            features = {}
+            if tiles is not None:
+                # the tiles to build stay in the store even if they are now empty
+                features = dict(((x, y), []) for tile_z, x, y in tiles if tile_z == z)
+            for row in db_data:
+                location = self._location(row)
+                if location is None:
+                    continue
+                for x, y, point_x, point_y in self._tiles_covering(location[0], location[1], z):
+                    if tiles is None or (x, y) in features:
+                        features.setdefault((x, y), []).append(
+                            self._feature(row, point_x, point_y))
+            for (x, y), tile_features in features.items():
+                self.store.put(z, x, y, self._encode(tile_features), built_since)
+                tile_count += 1
+        return tile_count
+
+    def refresh(self):
+        '''
+        Rebuild the stored tiles that were invalidated. Runs in the background,
+        but can also be called directly for a synchronous refresh.
+        '''
+        with self._dirty_lock:
+            tiles, self._dirty = self._dirty, set()
+        if not tiles:
+            return
+        try:
+            db_service = self.db_service_factory()
+            try:
+                self._build_stored_tiles(db_service, tiles)
+            finally:
+                db_service.db_connection.close()
+        except Exception:
+            # retried with the next refresh
+            with self._dirty_lock:
+                self._dirty.update(tiles)
+            raise
+
+    def precompute(self, db_service):
+        '''
+        Build all the non-empty tiles handled by the store with a single query,
+        and write them to it. Returns the number of tiles written.
+        '''
+        return self._build_stored_tiles(db_service)
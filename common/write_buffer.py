@@ -0,0 +1,296 @@
+'''
+Write-behind buffer that coalesces frequent UPDATEs of the same rows.
+Queued updates are merged per row (the last value of each column wins) and
+written in batched transactions, either after a short interval or once enough
+rows are pending.
+NB: the queued updates live in the memory of one worker process. Reads served
+by that worker show them, but reads served by other workers do not until they
+are written.
+'''
+from logging import error as log_error
+from math import isinf, isnan
+from numbers import Number
+from threading import Lock, Timer
+
+from common.exceptions import DBError
+
+
+def to_float(value):
+    '''
+    Convert 'value' to a finite float, raising ValueError if it is not a number
+    '''
+    number = float(value)
+    if isnan(number) or isinf(number):
+        raise ValueError('{} is not a finite number'.format(value))
+    return number
+
+
+class WriteBuffer(object):
+    '''
+    Queues the UPDATEs of some columns of some tables and flushes them to the database.
+    'columns' maps each table to {column: converter}, the columns whose updates
+    can be queued. Queued values are converted (and so validated) with their
+    converter, so that a bad value is rejected before the update is accepted.
+    Updates of any other column (e.g. with a unique constraint) must be run right away.
+    The pending updates are flushed 'flush_interval' seconds after the first one
+    was queued, or as soon as 'max_pending' rows have pending updates.
+    'db_service_factory' must return a new DBService (without a write buffer).
+    The flushes share one connection, which is only replaced after it fails.
+    'on_flush' is called with the name of each table after its updates are written.
+    '''
+
+    def __init__(self, db_service_factory, columns, flush_interval=0.5, max_pending=100,
+                 on_flush=None):
+        self.db_service_factory = db_service_factory
+        self.columns = columns
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.on_flush = on_flush
+        # pending updates: {table: {data_id: {column: new_value}}}
+        self._pending = {}
+        # updates taken out of '_pending' by a flush that is still running
+        self._flushing = {}
+        self._lock = Lock()
+        self._flush_lock = Lock()
+        self._timer = None
+        # DBService of the flushes, created on the first flush
+        self._db_service = None
+
+    def can_queue(self, table, new_data):
+        '''
+        Returns True if the update of 'new_data' in 'table' can be queued,
+        i.e. if all its columns can be queued
+        '''
+        table_columns = self.columns.get(table, {})
+        return len(new_data) > 0 and all(column in table_columns for column in new_data)
+
+    def convert(self, table, new_data):
+        '''
+        Return 'new_data' with its values converted for queueing.
+        Raises ValueError (or TypeError) if a value is invalid for its column.
+        '''
+        table_columns = self.columns[table]
+        return dict((column, table_columns[column](value))
+                    for column, value in new_data.items())
+
+    def is_pending(self, table, data_id):
+        '''
+        Returns True if the row of 'table' with the id 'data_id' has queued updates
+        '''
+        with self._lock:
+            return data_id in self._table_updates(table)
+
+    def has_pending_columns(self, table, columns):
+        '''
+        Returns True if any of 'columns' of 'table' has a queued update
+        '''
+        columns = set(columns)
+        if not columns:
+            return False
+        with self._lock:
+            for new_data in self._table_updates(table).values():
+                if columns.intersection(new_data):
+                    return True
+        return False
+
+    def queue_update(self, table, data_id, new_data):
+        '''
+        Merge 'new_data' into the pending update of the row of 'table' with the id 'data_id'
+        '''
+        with self._lock:
+            table_pending = self._pending.setdefault(table, {})
+            table_pending.setdefault(data_id, {}).update(new_data)
+            pending_count = sum(len(p) for p in self._pending.values())
+            if pending_count < self.max_pending:
+                self._schedule_flush()
+        if pending_count >= self.max_pending:
+            try:
+                self.flush()
+            except DBError as error:
+                # the update is safely queued and the flush will be retried,
+                # so the request that queued it has still succeeded
+                log_error('write_buffer.py >> queue_update(): ' + error.message)
+
+    def discard(self, table, data_id):
+        '''
+        Drop the pending update of the row of 'table' with the id 'data_id',
+        e.g. because the row is being deleted
+        '''
+        with self._lock:
+            self._pending.get(table, {}).pop(data_id, None)
+
+    def apply_overlay(self, table, columns, db_data):
+        '''
+        Return 'db_data' (the rows selected from 'table', with the given 'columns')
+        with the pending updates of 'table' applied to them.
+        The rows may either be dicts or sequences ordered as 'columns'.
+        '''
+        id_column = '{}_id'.format(table)
+        with self._lock:
+            table_pending = self._table_updates(table)
+        if not table_pending or id_column not in columns:
+            return db_data
+        id_index = columns.index(id_column)
+        overlaid_data = []
+        for row in db_data:
+            is_mapping = isinstance(row, dict)
+            data_id = row[id_column] if is_mapping else row[id_index]
+            new_data = table_pending.get(data_id)
+            if new_data:
+                if is_mapping:
+                    row = dict(row)
+                    for column, value in new_data.items():
+                        if column in row:
+                            row[column] = _coerce(row[column], value)
+                else:
+                    row = list(row)
+                    for column, value in new_data.items():
+                        if column in columns:
+                            index = columns.index(column)
+                            row[index] = _coerce(row[index], value)
+                    row = tuple(row)
+            overlaid_data.append(row)
+        return overlaid_data
+
+    def _table_updates(self, table):
+        '''
+        Return a copy of the updates of 'table' that are not in the database yet.
+        Must be called with '_lock' held.
+        '''
+        updates = {}
+        for source in (self._flushing, self._pending):
+            for data_id, new_data in source.get(table, {}).items():
+                updates.setdefault(data_id, {}).update(new_data)
+        return updates
+
+    def _background_flush(self):
+        try:
+            self.flush()
+        except DBError as error:
+            log_error('write_buffer.py >> _background_flush(): ' + error.message)
+
+    def _schedule_flush(self):
+        '''
+        Start the flush timer if it is not running. Must be called with '_lock' held.
+        '''
+        if self._timer is None:
+            self._timer = Timer(self.flush_interval, self._background_flush)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _restore(self, pending):
+        '''
+        Put the updates of a failed flush back in the queue, so they are retried.
+        The updates queued since the flush started are newer, so they win.
+        Must be called with '_lock' held.
+        '''
+        for table, updates in pending.items():
+            table_pending = self._pending.setdefault(table, {})
+            for data_id, new_data in updates.items():
+                merged_data = dict(new_data)
+                merged_data.update(table_pending.get(data_id, {}))
+                table_pending[data_id] = merged_data
+        if any(self._pending.values()):
+            self._schedule_flush()
+
+    def flush(self):
+        '''
+        Write all the pending updates to the database, one transaction per table.
+        Call this directly for a synchronous flush (e.g. in tests or on shutdown).
+        If the database cannot be reached, the updates stay queued and DBError is raised.
+        '''
+        with self._flush_lock:
+            with self._lock:
+                if self._timer is not None:
+                    self._timer.cancel()
+                    self._timer = None
+                pending = dict((t, dict(u)) for t, u in self._pending.items() if u)
+                self._pending = {}
+                # a separate copy, as rows are removed from 'pending' as they are written
+                self._flushing = dict((t, dict(u)) for t, u in pending.items())
+            if not pending:
+                return
+            try:
+                if self._db_service is None:
+                    self._db_service = self.db_service_factory()
+                for table in list(pending.keys()):
+                    self._flush_table(self._db_service, table, pending[table])
+                    del pending[table]
+            except DBError:
+                self._disconnect()
+                with self._lock:
+                    self._restore(pending)
+                raise
+            except Exception as error:
+                # e.g. the database connection could not be opened
+                self._disconnect()
+                with self._lock:
+                    self._restore(pending)
+                raise DBError(', '.join(pending.keys()), error)
+            finally:
+                with self._lock:
+                    self._flushing = {}
+
+    def _disconnect(self):
+        '''
+        Drop the connection of the flushes after an error, so the next flush reconnects.
+        Must be called with '_flush_lock' held.
+        '''
+        if self._db_service is not None:
+            try:
+                self._db_service.db_connection.close()
+            except Exception as error:
+                log_error('write_buffer.py >> _disconnect(): ' + str(error))
+            self._db_service = None
+
+    def close(self):
+        '''
+        Flush the pending updates and close the connection of the flushes,
+        e.g. before the worker exits
+        '''
+        try:
+            self.flush()
+        finally:
+            with self._flush_lock:
+                self._disconnect()
+
+    def _flush_table(self, db_service, table, updates):
+        '''
+        Write 'updates' to 'table'. The rows that are written (or dropped) are
+        removed from 'updates', so only the rows still to be written remain if it fails.
+        '''
+        try:
+            db_service.update_data_batch(table, updates)
+            updates.clear()
+        except DBError as error:
+            if not error.is_data_error:
+                raise
+            # one bad value (e.g. out of the range of its column) fails the whole batch,
+            # so the values are retried one by one and only the bad ones are dropped
+            for data_id in list(updates.keys()):
+                for column, value in list(updates[data_id].items()):
+                    try:
+                        db_service.update_data_batch(table, {data_id: {column: value}})
+                    except DBError as error:
+                        if not error.is_data_error:
+                            raise
+                        log_error(
+                            'write_buffer.py >> flush(): dropped update of {} of {} {}: {}'.format(
+                                column, table, data_id, error.message))
+                    del updates[data_id][column]
+                del updates[data_id]
+        if self.on_flush is not None:
+            self.on_flush(table)
+
+
+def _coerce(current_value, new_value):
+    '''
+    Convert a queued 'new_value' (e.g. a string from a form) to the type of
+    the value currently in the database, so the overlay reads like the database
+    '''
+    if isinstance(current_value, Number) and not isinstance(current_value, bool):
+        try:
+            return type(current_value)(new_value)
+        except (TypeError, ValueError, ArithmeticError):
+            return new_value
+    return new_value
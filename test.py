@@ -1,4 +1,694 @@
 '''
 Tests for the entire project
 '''
-import unittest
\ No newline at end of file
+import json
+import unittest
+from os import close as close_fd
+from os import environ, remove
+from os import path as os_path
+from random import Random
+from shutil import rmtree
+from struct import unpack
+from sqlite3 import OperationalError
+from sqlite3 import connect as connect_sqlite
+from tempfile import mkdtemp, mkstemp
+from time import time
+
+from common.bk_tree import (BKTree, FuzzyIndex, compile_pattern, edit_distance,
+                            max_search_distance)
+from common.db_service import DB_ENGINE_SQLITE, DBService
+from common.exceptions import (DBError, IndexNotReadyError, InvalidValuesError,
+                               SnapshotNotReadyError)
+from common.os_threads import DebouncedTask, allocate_lock
+from common.profiler import (CATEGORY_FLASK, CATEGORY_OTHER, CATEGORY_SQL,
+                             CATEGORY_VIEW, ProfileStore, categorise_stack)
+from common.snapshot import TableSnapshot
+from common.vector_tiles import (PointTiles, TileCache, TileStore, encode_point_layer,
+                                 lnglat_to_tile)
+from common.write_buffer import WriteBuffer, to_float
+
+
+def create_test_db(db_path):
+    with open('test.sql') as schema_file:
+        connect_sqlite(db_path).executescript(schema_file.read())
+
+
+# the app is configured when it is imported, so its files all go to a temporary directory
+APP_DIR = mkdtemp()
+environ.update({
+    'FLASK_DEBUG': '1',
+    'SQLITE_DB': os_path.join(APP_DIR, 'test.db'),
+    'SNAPSHOT_DIR': os_path.join(APP_DIR, 'snapshots'),
+    'PROFILE_DIR': os_path.join(APP_DIR, 'profiles'),
+    'PROFILE_TOKEN': 'test-token',
+    'TILE_DIR': os_path.join(APP_DIR, 'tiles'),
+    'FUZZY_INDEX_PATH': os_path.join(APP_DIR, 'indexes', 'pole_number.pickle'),
+})
+create_test_db(environ['SQLITE_DB'])
+import app  # pylint: disable=wrong-import-position
+
+
+def tearDownModule():
+    rmtree(APP_DIR)
+
+
+class WriteBufferTest(unittest.TestCase):
+    '''
+    Tests for the write-behind buffer of pole updates
+    '''
+
+    def setUp(self):
+        db_fd, self.db_path = mkstemp(suffix='.db')
+        close_fd(db_fd)
+        create_test_db(self.db_path)
+        self.connection_count = 0
+        self.write_buffer = WriteBuffer(
+            self.create_db_service, {'pole': {'lat': to_float, 'long': to_float}},
+            flush_interval=60, max_pending=100)
+        self.db_service = DBService(
+            connect_sqlite(self.db_path, isolation_level=None), DB_ENGINE_SQLITE,
+            write_buffer=self.write_buffer)
+
+    def tearDown(self):
+        if self.write_buffer._timer is not None:
+            self.write_buffer._timer.cancel()
+        self.write_buffer.db_service_factory = self.create_db_service
+        self.write_buffer.close()
+        self.db_service.db_connection.close()
+        remove(self.db_path)
+
+    def create_db_service(self):
+        self.connection_count += 1
+        return DBService(
+            connect_sqlite(self.db_path, isolation_level=None, check_same_thread=False),
+            DB_ENGINE_SQLITE)
+
+    def failing_db_service(self):
+        raise OperationalError('unable to open database file')
+
+    def disconnected_db_service(self):
+        db_service = self.create_db_service()
+        db_service.db_connection.close()
+        return db_service
+
+    def stored_pole(self, pole_id):
+        db_connection = connect_sqlite(self.db_path)
+        try:
+            return db_connection.execute(
+                'SELECT pole_id, pole_number, lat, long FROM pole WHERE pole_id=?',
+                [pole_id]).fetchone()
+        finally:
+            db_connection.close()
+
+    def test_updates_of_a_pole_are_merged(self):
+        self.db_service.update_data('pole', 1, {'lat': '1.5'})
+        self.db_service.update_data('pole', 1, {'lat': '2.5', 'long': '3.5'})
+        self.assertEqual(self.write_buffer._pending, {'pole': {1: {'lat': 2.5, 'long': 3.5}}})
+        self.assertEqual(self.stored_pole(1), (1, 'POLE_0', 100.123456, 101.123456))
+
+    def test_invalid_values_are_rejected_before_queueing(self):
+        self.assertRaises(
+            InvalidValuesError, self.db_service.update_data, 'pole', 1, {'lat': 'north'})
+        self.assertRaises(
+            InvalidValuesError, self.db_service.update_data, 'pole', 1, {'long': 'nan'})
+        self.assertFalse(self.write_buffer.is_pending('pole', 1))
+
+    def test_constrained_columns_are_updated_right_away(self):
+        self.db_service.update_data('pole', 1, {'lat': '1.5'})
+        self.db_service.update_data('pole', 1, {'pole_number': 'POLE_X', 'long': '2.5'})
+        self.assertEqual(self.stored_pole(1), (1, 'POLE_X', 1.5, 2.5))
+        self.assertFalse(self.write_buffer.is_pending('pole', 1))
+        self.assertRaises(
+            DBError, self.db_service.update_data, 'pole', 2, {'pole_number': 'POLE_X'})
+
+    def test_flushes_share_a_connection(self):
+        for lat in ('1.5', '2.5'):
+            self.db_service.update_data('pole', 1, {'lat': lat})
+            self.write_buffer.flush()
+        self.assertEqual(self.connection_count, 1)
+        self.assertEqual(self.stored_pole(1), (1, 'POLE_0', 2.5, 101.123456))
+
+    def test_overlay_shows_queued_updates(self):
+        self.write_buffer.queue_update('pole', 1, {'lat': '2.5', 'pole_number': 'POLE_X'})
+        columns = self.db_service.get_valid_columns('pole')
+        rows = [(1, 'POLE_0', 100.123456, 101.123456), (2, 'POLE_1', 101.123456, 102.123456)]
+        self.assertEqual(
+            self.write_buffer.apply_overlay('pole', columns, rows),
+            [(1, 'POLE_X', 2.5, 101.123456), (2, 'POLE_1', 101.123456, 102.123456)])
+        dict_rows = [dict(zip(columns, row)) for row in rows]
+        self.assertEqual(
+            self.write_buffer.apply_overlay('pole', columns, dict_rows)[0],
+            {'pole_id': 1, 'pole_number': 'POLE_X', 'lat': 2.5, 'long': 101.123456})
+        self.assertEqual(
+            self.db_service.select_data('pole', data_id=1), (1, 'POLE_X', 2.5, 101.123456))
+
+    def test_flush_writes_the_queued_updates(self):
+        self.write_buffer.queue_update('pole', 1, {'lat': '1.5'})
+        self.write_buffer.queue_update('pole', 2, {'long': '2.5'})
+        self.write_buffer.flush()
+        self.assertEqual(self.stored_pole(1), (1, 'POLE_0', 1.5, 101.123456))
+        self.assertEqual(self.stored_pole(2), (2, 'POLE_1', 101.123456, 2.5))
+        self.assertFalse(self.write_buffer.is_pending('pole', 1))
+
+    def test_filtering_on_a_queued_column_flushes_first(self):
+        self.write_buffer.queue_update('pole', 1, {'pole_number': 'POLE_X'})
+        db_data = self.db_service.select_data('pole', pole_number='POLE_X')
+        self.assertEqual(db_data, [(1, 'POLE_X', 100.123456, 101.123456)])
+        self.assertFalse(self.write_buffer.is_pending('pole', 1))
+
+    def test_failed_flush_keeps_the_updates(self):
+        self.write_buffer.queue_update('pole', 1, {'lat': '1.5', 'long': '1.5'})
+        self.write_buffer.db_service_factory = self.failing_db_service
+        self.assertRaises(DBError, self.write_buffer.flush)
+        self.assertTrue(self.write_buffer.is_pending('pole', 1))
+        self.assertIsNotNone(self.write_buffer._timer)
+        # a newer update wins over the restored one
+        self.write_buffer.queue_update('pole', 1, {'lat': '2.5'})
+        self.write_buffer.db_service_factory = self.create_db_service
+        self.write_buffer.flush()
+        self.assertEqual(self.stored_pole(1), (1, 'POLE_0', 2.5, 1.5))
+
+    def test_lost_connection_keeps_the_updates(self):
+        self.write_buffer.queue_update('pole', 1, {'lat': '1.5'})
+        self.write_buffer.db_service_factory = self.disconnected_db_service
+        self.assertRaises(DBError, self.write_buffer.flush)
+        self.assertEqual(self.write_buffer._pending, {'pole': {1: {'lat': '1.5'}}})
+
+    def test_failed_flush_on_select_raises_db_error(self):
+        self.write_buffer.queue_update('pole', 1, {'lat': '1.5'})
+        self.write_buffer.db_service_factory = self.failing_db_service
+        self.assertRaises(DBError, self.db_service.select_data, 'pole', lat='1.5')
+        self.assertTrue(self.write_buffer.is_pending('pole', 1))
+
+    def test_only_invalid_values_are_dropped(self):
+        # POLE_2 is already the pole_number of another pole
+        self.write_buffer.queue_update('pole', 1, {'lat': 5.5, 'pole_number': 'POLE_2'})
+        self.write_buffer.queue_update('pole', 2, {'lat': 1.5})
+        self.write_buffer.flush()
+        self.assertEqual(self.stored_pole(1), (1, 'POLE_0', 5.5, 101.123456))
+        self.assertEqual(self.stored_pole(2), (2, 'POLE_1', 1.5, 102.123456))
+        self.assertFalse(self.write_buffer.is_pending('pole', 1))
+
+
+class SnapshotTest(unittest.TestCase):
+    '''
+    Tests for the prebuilt snapshot of the poles, served at /poles/snapshot
+    '''
+
+    def setUp(self):
+        self.version = app.POLES_SNAPSHOT.rebuild()
+        self.client = app.app.test_client()
+
+    def test_snapshot_is_served_with_its_version(self):
+        response = self.client.get('/poles/snapshot')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers['ETag'], '"{}"'.format(self.version))
+        self.assertEqual(response.headers['Accept-Ranges'], 'bytes')
+        self.assertEqual(response.data[:2], b'\x1f\x8b')  # gzip magic number
+
+    def test_current_version_is_not_modified(self):
+        response = self.client.get(
+            '/poles/snapshot', headers={'If-None-Match': '"{}"'.format(self.version)})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.data, b'')
+
+    def test_byte_range(self):
+        full = self.client.get('/poles/snapshot').data
+        response = self.client.get('/poles/snapshot', headers={'Range': 'bytes=10-19'})
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response.headers['Content-Range'], 'bytes 10-19/{}'.format(len(full)))
+        self.assertEqual(response.data, full[10:20])
+
+    def test_range_of_another_version_sends_the_whole_snapshot(self):
+        response = self.client.get(
+            '/poles/snapshot', headers={'Range': 'bytes=10-19', 'If-Range': '"old"'})
+        self.assertEqual(response.status_code, 200)
+
+    def test_unsatisfiable_range(self):
+        length = len(self.client.get('/poles/snapshot').data)
+        response = self.client.get(
+            '/poles/snapshot', headers={'Range': 'bytes={}-'.format(length + 10)})
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response.headers['Content-Range'], 'bytes */{}'.format(length))
+
+    def test_missing_snapshot_is_not_built_in_the_request(self):
+        snapshot_dir = mkdtemp()
+        built = allocate_lock()
+        built.acquire()
+
+        def create_db_service():
+            built.release()
+            raise OperationalError('unable to open database file')
+
+        try:
+            snapshot = TableSnapshot('pole', create_db_service, snapshot_dir)
+            self.assertRaises(SnapshotNotReadyError, snapshot.current)
+            # the build was started in the background
+            built.acquire()
+        finally:
+            rmtree(snapshot_dir)
+
+    def test_removed_snapshot_file_is_not_served(self):
+        file_name = open(app.POLES_SNAPSHOT.pointer_path).read()
+        remove(os_path.join(app.POLES_SNAPSHOT.snapshot_dir, file_name))
+        app.POLES_SNAPSHOT._mapped = (None, None)
+        response = self.client.get('/poles/snapshot')
+        self.assertEqual(response.status_code, 503)
+        self.assertIn('Retry-After', response.headers)
+
+
+class DebouncedTaskTest(unittest.TestCase):
+    '''
+    Tests for the debounced background tasks, e.g. the snapshot rebuilds
+    '''
+
+    def test_burst_runs_once(self):
+        runs = []
+        done = allocate_lock()
+        done.acquire()
+
+        def run():
+            runs.append(time())
+            done.release()
+
+        task = DebouncedTask(run, delay=0.05)
+        for _ in range(5):
+            task.schedule()
+        done.acquire()
+        self.assertEqual(len(runs), 1)
+
+    def test_run_is_not_postponed_past_the_deadline(self):
+        task = DebouncedTask(lambda: None, delay=60, max_delay=120)
+        started_at = time()
+        task.schedule()
+        first_due_at = task.due_at
+        task.schedule(delay=600)
+        self.assertLessEqual(task.due_at, started_at + 121)
+        self.assertGreaterEqual(task.due_at, first_due_at)
+        # runs right away, so the thread of the task ends
+        task.schedule(delay=0)
+
+
+class ProfilerTest(unittest.TestCase):
+    '''
+    Tests for the request profiler and the stored profiles
+    '''
+
+    def setUp(self):
+        self.profile_dir = mkdtemp()
+        self.client = app.app.test_client()
+
+    def tearDown(self):
+        rmtree(self.profile_dir)
+
+    def test_stacks_are_categorised_by_their_innermost_known_frame(self):
+        self.assertEqual(categorise_stack(
+            ['/srv/app.py', '/lib/flask/app.py', '/srv/api/views/poles.py',
+             '/srv/common/db_service.py']), CATEGORY_SQL)
+        self.assertEqual(categorise_stack(
+            ['/lib/werkzeug/serving.py', '/lib/flask/app.py', '/srv/api/views/poles.py',
+             '/srv/common/snapshot.py']), CATEGORY_VIEW)
+        self.assertEqual(categorise_stack(
+            ['/lib/werkzeug/serving.py', '/lib/flask/ctx.py']), CATEGORY_FLASK)
+        self.assertEqual(categorise_stack(['/srv/manage.py']), CATEGORY_OTHER)
+
+    def test_only_the_newest_profiles_are_kept(self):
+        store = ProfileStore(self.profile_dir, max_profiles=2)
+        profile_ids = [store.save({'path': '/poles/{}'.format(i)}) for i in range(3)]
+        self.assertEqual([p['id'] for p in store.list()], profile_ids[:0:-1])
+        self.assertIsNone(store.get(profile_ids[0]))
+        self.assertEqual(store.get(profile_ids[2])['path'], '/poles/2')
+
+    def test_max_profiles_must_be_positive(self):
+        self.assertRaises(ValueError, ProfileStore, self.profile_dir, 0)
+
+    def test_profiles_require_the_token(self):
+        self.assertEqual(self.client.get('/admin/profiles').status_code, 403)
+        response = self.client.get('/admin/profiles', headers={'X-Profile': 'wrong'})
+        self.assertEqual(response.status_code, 403)
+
+    def test_request_with_the_token_is_profiled(self):
+        self.client.get('/poles/1', headers={'X-Profile': 'test-token'})
+        response = self.client.get('/admin/profiles', headers={'X-Profile': 'test-token'})
+        self.assertEqual(response.status_code, 200)
+        profile = json.loads(response.data.decode('utf-8'))[0]
+        self.assertEqual(
+            (profile['method'], profile['path'], profile['endpoint']),
+            ('GET', '/poles/1', 'poles_api'))
+        response = self.client.get(
+            '/admin/profiles/' + profile['id'], headers={'X-Profile': 'test-token'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'text/plain')
+
+
+class TileStorageTest(unittest.TestCase):
+    '''
+    Tests for the cache and the shared store of the vector tiles
+    '''
+
+    def setUp(self):
+        self.tile_dir = mkdtemp()
+        self.store = TileStore(self.tile_dir, max_zoom=6)
+
+    def tearDown(self):
+        rmtree(self.tile_dir)
+
+    def test_stored_tiles_are_shared(self):
+        self.store.put(0, 0, 0, b'tile', time())
+        self.assertEqual(TileStore(self.tile_dir, max_zoom=6).get(0, 0, 0), b'tile')
+        self.assertIsNone(self.store.get(1, 0, 0))
+
+    def test_older_tile_does_not_replace_a_newer_one(self):
+        built_since = time() - 1
+        self.store.put(1, 0, 0, b'new', time())
+        self.store.put(1, 0, 0, b'old', built_since)
+        self.assertEqual(self.store.get(1, 0, 0), b'new')
+        self.store.put(1, 0, 0, b'newer', time() + 1)
+        self.assertEqual(self.store.get(1, 0, 0), b'newer')
+
+    def test_invalidation_only_rejects_the_invalidated_tile(self):
+        cache = TileCache(max_size=2)
+        generation = cache.generation
+        cache.invalidate(10, 1, 1)
+        cache.put(10, 1, 1, b'stale', generation=generation)
+        cache.put(10, 2, 2, b'tile', generation=generation)
+        self.assertIsNone(cache.get(10, 1, 1))
+        self.assertEqual(cache.get(10, 2, 2), b'tile')
+        # once the invalidation is forgotten, older builds are all rejected
+        cache.invalidate(10, 3, 3)
+        cache.invalidate(10, 4, 4)
+        cache.put(10, 5, 5, b'stale', generation=generation)
+        self.assertIsNone(cache.get(10, 5, 5))
+
+
+def levenshtein(first, second):
+    '''
+    Return the edit distance between 'first' and 'second', by dynamic programming
+    '''
+    previous = list(range(len(second) + 1))
+    for i, first_char in enumerate(first, 1):
+        current = [i]
+        for j, second_char in enumerate(second, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1,
+                               previous[j - 1] + (first_char != second_char)))
+        previous = current
+    return previous[-1]
+
+
+def random_keys(count, seed):
+    generator = Random(seed)
+    return [u''.join(generator.choice(u'AB1_') for _ in range(generator.randint(0, 8)))
+            for _ in range(count)]
+
+
+class EditDistanceTest(unittest.TestCase):
+    '''
+    Tests for the edit distance and the BK-tree, against a plain Levenshtein distance
+    '''
+
+    def test_edit_distance(self):
+        keys = random_keys(60, seed=1)
+        for pattern in keys:
+            compiled_pattern = compile_pattern(pattern)
+            for text in keys:
+                self.assertEqual(edit_distance(compiled_pattern, text),
+                                 levenshtein(pattern, text), (pattern, text))
+
+    def test_search_finds_all_the_keys_within_the_distance(self):
+        keys = random_keys(300, seed=2)
+        tree = BKTree()
+        for item_id, key in enumerate(keys):
+            tree.add(key, item_id)
+        for item_id in range(0, len(keys), 3):
+            tree.remove(keys[item_id], item_id)
+        for query in random_keys(20, seed=3):
+            for max_distance in range(3):
+                expected = sorted(
+                    (levenshtein(query, key), item_id) for item_id, key in enumerate(keys)
+                    if item_id % 3 and levenshtein(query, key) <= max_distance)
+                found = sorted((distance, item_id) for distance, _, ids
+                               in tree.search(query, max_distance) for item_id in ids)
+                self.assertEqual(found, expected, (query, max_distance))
+
+
+class FuzzyIndexTest(unittest.TestCase):
+    '''
+    Tests for the typo-tolerant index of the pole numbers
+    '''
+
+    def setUp(self):
+        db_fd, self.db_path = mkstemp(suffix='.db')
+        close_fd(db_fd)
+        create_test_db(self.db_path)
+        self.save_dir = mkdtemp()
+        self.index = self.create_index(self.create_db_service)
+
+    def tearDown(self):
+        remove(self.db_path)
+        rmtree(self.save_dir)
+
+    def create_db_service(self):
+        return DBService(connect_sqlite(self.db_path, isolation_level=None), DB_ENGINE_SQLITE)
+
+    def failing_db_service(self):
+        raise OperationalError('unable to open database file')
+
+    def create_index(self, db_service_factory):
+        return FuzzyIndex(
+            'pole', ['pole_id', 'pole_number', 'lat', 'long'], 'pole_number', 'pole_id',
+            db_service_factory, max_age=60, save_path=self.save_dir + '/pole_number.pickle')
+
+    def test_search_does_not_wait_for_the_build(self):
+        index = self.create_index(self.failing_db_service)
+        self.assertRaises(IndexNotReadyError, index.search, 'POLE_1', 1)
+        self.index.build()
+        self.assertEqual(self.index.search('POLE_1', 0), [(0, 2, 'POLE_1')])
+
+    def test_builds_are_single_flight(self):
+        nested_builds = []
+
+        def create_db_service():
+            nested_builds.append(self.index.build())
+            return self.create_db_service()
+
+        self.index.db_service_factory = create_db_service
+        self.assertTrue(self.index.build())
+        self.assertEqual(nested_builds, [False])
+
+    def test_saved_index_is_loaded_by_other_workers(self):
+        self.index.build()
+        other_index = self.create_index(self.failing_db_service)
+        other_index.load()
+        self.assertEqual(other_index.search('POLE_1', 0), [(0, 2, 'POLE_1')])
+
+    def test_saved_index_is_stale_after_a_change(self):
+        self.index.build()
+        self.index.update(2, 'POLE_11')
+        other_index = self.create_index(self.failing_db_service)
+        self.assertRaises(OperationalError, other_index.load)
+
+    def test_removed_keys_are_not_found(self):
+        self.index.build()
+        for item_id in range(100, 200):
+            self.index.add(item_id, 'X{}'.format(item_id))
+        for item_id in range(100, 200):
+            self.index.remove(item_id)
+        self.assertEqual(self.index.search('X150', 0), [])
+        self.assertEqual(self.index.search('POLE_1', 0), [(0, 2, 'POLE_1')])
+
+
+class FuzzySearchAPITest(unittest.TestCase):
+    '''
+    Tests for the typo-tolerant search of the poles, served at /poles/fuzzy
+    '''
+
+    def setUp(self):
+        app.POLE_NUMBER_INDEX.build(wait=True)
+        self.client = app.app.test_client()
+
+    def tearDown(self):
+        app.POLE_NUMBER_INDEX.build(wait=True)
+
+    def search(self, **query):
+        response = self.client.get('/poles/fuzzy', query_string=query)
+        return response.status_code, json.loads(response.data.decode('utf-8'))
+
+    def test_poles_are_found_closest_first(self):
+        status, results = self.search(q='pole_1', max_distance=1)
+        self.assertEqual(status, 200)
+        self.assertEqual([(result['distance'], result['pole'][1]) for result in results],
+                         [(0, 'POLE_1')] + [(1, 'POLE_{}'.format(i)) for i in (0, 2, 3, 4, 5,
+                                                                              6, 7, 8, 9)])
+
+    def test_poles_out_of_date_in_the_index_are_dropped(self):
+        # as if the pole number was changed through another worker
+        app.POLE_NUMBER_INDEX.update(2, 'OLD_NUMBER')
+        self.assertEqual(self.search(q='OLD_NUMBER', max_distance=0), (200, []))
+
+    def test_max_distance_is_limited(self):
+        max_distance = max_search_distance(app.app.config['FUZZY_MAX_DISTANCE'])
+        self.assertEqual(self.search(q='POLE_1', max_distance=max_distance)[0], 200)
+        self.assertEqual(self.search(q='POLE_1', max_distance=max_distance + 1)[0], 451)
+
+
+def _read_varint(data, pos):
+    value = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        shift += 7
+        if not byte & 0x80:
+            return value, pos
+
+
+def _read_fields(data):
+    '''
+    Return the (field number, value) of a protobuf message, with the value
+    of the length delimited fields as a bytearray
+    '''
+    data = bytearray(data)
+    fields = []
+    pos = 0
+    while pos < len(data):
+        key, pos = _read_varint(data, pos)
+        field_number, wire_type = key >> 3, key & 7
+        if wire_type == 0:
+            value, pos = _read_varint(data, pos)
+        elif wire_type == 1:
+            value, pos = unpack('<d', bytes(data[pos:pos + 8]))[0], pos + 8
+        else:
+            length, pos = _read_varint(data, pos)
+            value, pos = data[pos:pos + length], pos + length
+        fields.append((field_number, value))
+    return fields
+
+
+def _read_packed(data):
+    values = []
+    pos = 0
+    while pos < len(data):
+        value, pos = _read_varint(data, pos)
+        values.append(value)
+    return values
+
+
+def _unzigzag(value):
+    return (value >> 1) ^ -(value & 1)
+
+
+def decode_tile(tile):
+    '''
+    Decode a vector tile of a single layer of points, as
+    (layer name, extent, [(feature id, x, y, properties)])
+    '''
+    (_, layer), = _read_fields(tile)
+    name, extent, keys, values, features = None, None, [], [], []
+    for field_number, value in _read_fields(layer):
+        if field_number == 1:
+            name = value.decode('utf-8')
+        elif field_number == 2:
+            features.append(dict(_read_fields(value)))
+        elif field_number == 3:
+            keys.append(value.decode('utf-8'))
+        elif field_number == 4:
+            (value_type, value), = _read_fields(value)
+            values.append({1: lambda v: v.decode('utf-8'), 3: float, 5: int,
+                           6: _unzigzag, 7: bool}[value_type](value))
+        elif field_number == 5:
+            extent = value
+    points = []
+    for feature in features:
+        tags = _read_packed(feature.get(2, bytearray()))
+        command, x, y = _read_packed(feature[4])
+        assert (feature[3], command) == (1, 9)  # a POINT, with one MoveTo
+        properties = dict((keys[tags[i]], values[tags[i + 1]]) for i in range(0, len(tags), 2))
+        points.append((feature.get(1), _unzigzag(x), _unzigzag(y), properties))
+    return name, extent, points
+
+
+class PointTilesTest(unittest.TestCase):
+    '''
+    Tests for the vector tiles of the poles
+    '''
+
+    def setUp(self):
+        db_fd, self.db_path = mkstemp(suffix='.db')
+        close_fd(db_fd)
+        create_test_db(self.db_path)
+        # moves the test poles to valid latitudes, between 0 and 10 degrees
+        self.db_service = self.create_db_service()
+        self.db_service.db_connection.execute('UPDATE pole SET lat=lat-100, long=long-100')
+        self.tile_dir = mkdtemp()
+
+    def tearDown(self):
+        self.db_service.db_connection.close()
+        remove(self.db_path)
+        rmtree(self.tile_dir)
+
+    def create_db_service(self):
+        return DBService(connect_sqlite(self.db_path, isolation_level=None), DB_ENGINE_SQLITE)
+
+    def create_tiles(self, store=None, cluster_size=64):
+        return PointTiles(
+            'pole', self.db_service.get_valid_columns('pole'), TileCache(), store=store,
+            db_service_factory=self.create_db_service, refresh_delay=60, id_column='pole_id',
+            property_columns=('pole_number',), layer_name='poles', cluster_size=cluster_size)
+
+    def test_encoded_layer_decodes_to_the_features(self):
+        tile = encode_point_layer('poles', [
+            (7, 10, 20, {'pole_number': u'POLE_7', 'pole_id': 7}),
+            (None, -3, 4096, {'weight': 1.5, 'is_new': True, 'offset': -2, 'note': None}),
+        ])
+        self.assertEqual(decode_tile(tile), ('poles', 4096, [
+            (7, 10, 20, {'pole_number': u'POLE_7', 'pole_id': 7}),
+            (None, -3, 4096, {'weight': 1.5, 'is_new': True, 'offset': -2}),
+        ]))
+
+    def test_point_on_the_edges_is_in_all_the_tiles_around_it(self):
+        tiles = self.create_tiles()
+        self.assertEqual(lnglat_to_tile(0, 0, 1), (1.0, 1.0))
+        self.assertEqual(sorted(tiles._tiles_covering(0, 0, 1)), [
+            (0, 0, 4096, 4096), (0, 1, 4096, 0), (1, 0, 0, 4096), (1, 1, 0, 0)])
+        # within the buffer of the west edge of the tile (1, 0) only
+        self.assertEqual(sorted((x, y) for x, y, _, _ in tiles._tiles_covering(0.5, 45, 1)),
+                         [(0, 0), (1, 0)])
+        self.assertEqual([(x, y) for x, y, _, _ in tiles._tiles_covering(90, 45, 1)], [(1, 0)])
+
+    def test_nearby_points_are_clustered(self):
+        tiles = self.create_tiles()
+        _, _, points = decode_tile(tiles._encode([
+            (1, 10, 10, {'pole_number': 'POLE_1'}),
+            (2, 20, 30, {'pole_number': 'POLE_2'}),
+            (3, 1000, 1000, {'pole_number': 'POLE_3'}),
+        ]))
+        self.assertEqual(points, [
+            (None, 15, 20, {'point_count': 2}), (3, 1000, 1000, {'pole_number': u'POLE_3'})])
+
+    def test_update_invalidates_the_old_and_new_positions(self):
+        tiles = self.create_tiles()
+        old_x, old_y = [int(c) for c in lnglat_to_tile(1.123456, 0.123456, 10)]
+        new_x, new_y = [int(c) for c in lnglat_to_tile(20, 30, 10)]
+        for x, y in ((old_x, old_y), (new_x, new_y), (0, 0)):
+            tiles.cache.put(10, x, y, b'tile')
+        old_pole = self.db_service.select_data('pole', data_id=1)
+        tiles.invalidate_update(old_pole, {'lat': '30', 'long': '20'})
+        self.assertIsNone(tiles.cache.get(10, old_x, old_y))
+        self.assertIsNone(tiles.cache.get(10, new_x, new_y))
+        self.assertEqual(tiles.cache.get(10, 0, 0), b'tile')
+
+    def test_stored_tile_is_served_until_it_is_refreshed(self):
+        tiles = self.create_tiles(TileStore(self.tile_dir, max_zoom=2), cluster_size=1)
+        x, y = [int(c) for c in lnglat_to_tile(5, 5, 2)]
+        tile = tiles.get_tile(self.db_service, 2, x, y)
+        self.assertEqual(len(decode_tile(tile)[2]), 10)
+        old_pole = self.db_service.delete_data('pole', 1)
+        tiles.invalidate_row(old_pole)
+        self.assertEqual(tiles.get_tile(self.db_service, 2, x, y), tile)
+        tiles.refresh()
+        _, _, points = decode_tile(tiles.get_tile(self.db_service, 2, x, y))
+        self.assertEqual(sorted(p[0] for p in points), list(range(2, 11)))
+
+
+if __name__ == '__main__':
+    unittest.main()